@@ -1,8 +1,29 @@
-import streamlit as st
 import time
-import google.generativeai as genai
+script_started = time.perf_counter()  # Timed from the first import for the cold-start and rerun-cost figures
+import streamlit as st
+from streamlit.errors import StreamlitAPIException
+import functools
+import os
+import uuid
 from datetime import datetime, timedelta
+import numpy as np
+
+from rooftop_core import (
+    ADMIN_USERS, CHAT_DB, CHAT_HISTORY_TOKENS, CHAT_THREAD_IDLE, FORUM_DB, FORUM_PAGE_SIZE, FORUM_REPLY_LIMIT,
+    FORUM_SEARCH_LIMIT, GENERATION_BURST, GENERATION_CONCURRENCY, GENERATION_RATE, GENERATION_RETRIES,
+    METRICS_REFRESH_SECONDS, PROMPT_ANSWER_DB, PROMPTS, REMINDER_DB, REMINDER_LABELS, REMINDER_PANEL_SIZE,
+    REMINDER_REFRESH_SECONDS, RESPONSE_CACHE_DB, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, TRUSTED_PROXIES, USER_DB,
+    answer_key, answer_question, deep_size, estimate_tokens, get_chat_model, get_chat_store, get_dispatcher,
+    get_forum_store, get_metrics, get_prewarm_job, get_prompt_answer_store, get_reminder_scheduler,
+    get_response_cache, get_session_footprints, get_single_flight, get_startup_report, get_user_store,
+    index_entries, logger, read_session_cookie, retrieve, start_prewarm, stream_answer, stream_chat,
+    summarize_older_turns, timed_chunks, with_context, write_session_cookie,
+)
+
 #replace your api key
+API_KEY = os.environ.get("GOOGLE_API_KEY", "API KEY")  # Replace with your actual API key, or set GOOGLE_API_KEY
+GEMINI_MODEL = "gemini-1.5-flash"  # Using Flash 2 (Free version)
+GENERATION_CONFIG = {}  # e.g. {"temperature": 0.7}
 # Set page title and layout
 st.set_page_config(page_title="RoofTop Gardening", layout="wide")
 
@@ -23,65 +44,269 @@ page_bg_img = f"""
 """
 st.markdown(page_bg_img, unsafe_allow_html=True)
 
-# Login Functionality
+# Login Functionality. Checks the password against the user store and puts a signed token in the session cookie,
+# so a refresh, a new tab or another worker restores the login without the password.
+# Returns "ok", "invalid" or "throttled".
 def login(username, password):
-    valid_users = ["sanketh", "nikhil", "karthik", "shiva"]
-    if username in valid_users and password == "rooftop":
-        st.session_state.logged_in = True
-        st.session_state.username = username
-        st.session_state.water_start_time = datetime.now()
-        st.session_state.fertilizer_start_time = datetime.now()
-        return True
-    return False
+    users = get_user_store(USER_DB)
+    with get_metrics().span("login"):
+        result = users.authenticate(username, password, client_address())
+    get_metrics().count("logins", result=result)
+    if result == "ok":
+        start_session(username)
+        st.session_state.session_cookie = users.issue_token(username)
+    return result
+
+def start_session(username):
+    st.session_state.logged_in = True
+    st.session_state.username = username
+    get_reminder_scheduler(REMINDER_DB).ensure_defaults(username)
+
+# Client address for login throttling; None where unknown, e.g. in tests. X-Forwarded-For is only followed
+# through TRUSTED_PROXIES, since anyone can send the header: the address is the last hop a trusted proxy saw.
+def client_address():
+    address = st.context.ip_address
+    hops = [hop.strip() for hop in st.context.headers.get("X-Forwarded-For", "").split(",") if hop.strip()]
+    while address in TRUSTED_PROXIES and hops:
+        address = hops.pop()
+    return address
 
 # Initialize session state for login and timers
 if "logged_in" not in st.session_state:
     st.session_state.logged_in = False
 if "username" not in st.session_state:
     st.session_state.username = ""
-if "water_start_time" not in st.session_state:
-    st.session_state.water_start_time = None
-if "fertilizer_start_time" not in st.session_state:
-    st.session_state.fertilizer_start_time = None
-if "forum_data" not in st.session_state:
-    st.session_state.forum_data = []
 if "replying" not in st.session_state:
-    st.session_state.replying = {}
-
-# Function to calculate remaining time and progress
-def calculate_progress(start_time, total_duration):
-    if start_time is None:
-        return 0, "Login Required"
-    elapsed_time = datetime.now() - start_time
-    remaining_time = total_duration - elapsed_time.total_seconds()
+    st.session_state.replying = set()  # Post ids with an open reply form
+if "showing_replies" not in st.session_state:
+    st.session_state.showing_replies = set()  # Post ids with their replies expanded
+if "forum_cursors" not in st.session_state:
+    st.session_state.forum_cursors = []
+if "model_time_saved" not in st.session_state:
+    st.session_state.model_time_saved = 0.0
+if "selected_prompt" not in st.session_state:
+    st.session_state.selected_prompt = None
+if "rerun_stats" not in st.session_state:
+    st.session_state.rerun_stats = {}
+if "chat_id" not in st.session_state:
+    st.session_state.chat_id = uuid.uuid4().hex  # Keys the conversation of a session that is not logged in
+
+# Function to calculate progress and remaining seconds for arrays of reminders in one pass
+def calculate_progress(start_times, total_durations, now):
+    elapsed_time = now - start_times
+    remaining_time = total_durations - elapsed_time
+    progress = np.clip(elapsed_time / total_durations * 100, 0, 100)
+    return progress, remaining_time
+
+def progress_message(remaining_time):
     if remaining_time <= 0:
-        return 100, "Time to water/fertilize!"
-    progress = (elapsed_time.total_seconds() / total_duration) * 100
-    return min(progress, 100), f"Time left: {timedelta(seconds=int(remaining_time))}"
+        return "Time to water/fertilize!"
+    return f"Time left: {timedelta(seconds=int(remaining_time))}"
+
+# Show the dispatcher queue so slow answers can be told apart from a busy upstream
+def show_dispatcher_stats():
+    stats = get_dispatcher(GENERATION_CONCURRENCY, GENERATION_RATE, GENERATION_BURST, GENERATION_RETRIES).stats
+    admitted = stats["completed"] + stats["failed"] + stats["running"]
+    avg_wait = stats["wait_time"] / admitted * 1000 if admitted else 0.0
+    st.caption(
+        f"🚦 Queue: {stats['waiting']} waiting, {stats['running']} running · "
+        f"avg wait {avg_wait:.0f} ms (max {stats['max_wait'] * 1000:.0f} ms) · "
+        f"{stats['retries']} retries, {stats['failed']} failed · "
+        f"{get_single_flight().stats['collapsed']} identical requests collapsed"
+    )
+
+# Render an answer token by token as it arrives, or in one piece after a spinner
+def render_answer(chunks, stream_mode, stats):
+    if stream_mode:
+        st.subheader("🤖 AI Response:")
+        st.write_stream(timed_chunks(chunks, stats))
+    else:
+        with st.spinner("Thinking... 💡"):
+            for _ in timed_chunks(chunks, stats):
+                pass
+        st.subheader("🤖 AI Response:")
+        st.markdown(f"**{stats['text']}**")
+    get_metrics().observe("answer", stats["elapsed"], cached=bool(stats.get("cached")))
+    if stats["first_token"] is not None:
+        get_metrics().observe("answer_first_token", stats["first_token"], cached=bool(stats.get("cached")))
+
+# Chatbot answer for a typed question: a near-duplicate's stored answer when one is close enough,
+# otherwise a generated answer with related snippets from the prompts, past answers and forum as context
+def answer_text_question(model, question, stream_mode, response):
+    reuse, context = retrieve(question)
+    if reuse is not None:
+        get_metrics().count("semantic_answers", result="reused")
+        response.update(input_tokens=0, output_tokens=0)
+        render_answer([reuse["answer"]], stream_mode, response)
+        st.caption(f"♻️ Reused the answer to a similar question ({reuse['score']:.2f} similar): {reuse['text']}")
+        return
+    get_metrics().count("semantic_answers", result="context" if context else "none")
+    prompt = with_context(question, context)
+    render_answer(stream_answer(model, question, response, prompt=prompt), stream_mode, response)
+    generated = not response["cached"] and not response["collapsed"]
+    response.update(input_tokens=estimate_tokens(prompt) if generated else 0, output_tokens=estimate_tokens(response["text"]) if generated else 0)
+    show_answer_stats(response)
+    if context:
+        st.caption(f"🧭 Added {len(context)} related snippets as context: " + " · ".join(hit["text"][:60] for hit in context))
+
+# Answer a follow-up within the user's live conversation. An exact repeat of a cached question is served from
+# the response cache; otherwise the reply depends on the history, so answer reuse is skipped, while retrieved
+# snippets are still added as context
+def answer_follow_up(model, question, window, stream_mode, response):
+    cache = get_response_cache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_DB)
+    start = time.perf_counter()
+    answer = cache.get(answer_key(question))
+    if answer is not None:
+        cache.record(True, time.perf_counter() - start)
+        response.update(cached=True, collapsed=False, input_tokens=0, output_tokens=0)
+        render_answer([answer], stream_mode, response)
+        show_answer_stats(response)
+        return
+    _, context = retrieve(question)
+    render_answer(stream_chat(model, window, with_context(question, context), response), stream_mode, response)
+    turns = len(window["turns"])
+    summary_note = " and a summary of earlier ones" if window["summary"] else ""
+    st.caption(f"💬 Answered with {turns} recent turn{'' if turns == 1 else 's'}{summary_note}")
+
+# Keep the turn in the user's conversation with its token counts, then fold older turns into the summary
+def record_chat_turn(model, chat_store, user, question, response):
+    chat_store.add_turn(user, question, response["text"], response["input_tokens"], response["output_tokens"])
+    summarize_older_turns(model, chat_store, user)
+    st.caption(f"🔢 This turn: {response['input_tokens']} input tokens, {response['output_tokens']} output tokens sent upstream")
+
+# Rerun cost per scope: full script runs versus the fragments that rerun on their own
+def record_run(scope, started):
+    stats = st.session_state.rerun_stats.setdefault(scope, {"runs": 0, "total": 0.0, "last": 0.0})
+    stats["last"] = time.perf_counter() - started
+    stats["runs"] += 1
+    stats["total"] += stats["last"]
+    get_metrics().observe("script_run", stats["last"], scope=scope)
+
+# Rerun only the calling fragment. A full script run, which is how AppTest drives fragments,
+# cannot scope a rerun to a fragment, so it reruns the whole page instead.
+def rerun_fragment():
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
+# st.fragment that also records how often it reruns and how long each run takes
+def timed_fragment(scope, run_every=None):
+    def decorate(render):
+        @functools.wraps(render)
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return render(*args, **kwargs)
+            finally:
+                record_run(scope, started)
+        return st.fragment(timed, run_every=run_every)
+    return decorate
+
+# Show how an answer was served along with the process-wide cache counters
+def show_answer_stats(answer):
+    stats = get_response_cache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_DB).stats
+    if answer.get("cached"):
+        source = "⚡ Served from cache"
+    elif answer.get("collapsed"):
+        source = "🔗 Shared with an identical question in flight"
+    else:
+        source = "🌐 Generated"
+    avg_hit = stats["hit_time"] / stats["hits"] * 1000 if stats["hits"] else 0.0
+    avg_miss = stats["miss_time"] / stats["misses"] * 1000 if stats["misses"] else 0.0
+    st.caption(
+        f"{source} in {answer['elapsed'] * 1000:.1f} ms · first token {answer['first_token'] * 1000:.0f} ms · "
+        f"{answer['tokens_per_sec']:.1f} tokens/s · cache hits {stats['hits']} (avg {avg_hit:.1f} ms), "
+        f"misses {stats['misses']} (avg {avg_miss:.0f} ms)"
+    )
+
+# Reminders panel. It reruns on its own every REMINDER_REFRESH_SECONDS, so timers tick
+# and due alerts show up without rerunning the rest of the page. Progress for all of a
+# user's reminders is computed in one vectorized pass; only the next few due are drawn.
+@timed_fragment("reminders", run_every=REMINDER_REFRESH_SECONDS)
+def reminders_panel():
+    st.write("🌿 Reminders")
+    if not st.session_state.logged_in:
+        for label in REMINDER_LABELS.values():
+            st.progress(0.0)
+            st.write(f"{label}: Login Required")
+        return
+
+    panel_start = time.perf_counter()
+    username = st.session_state.username
+    scheduler = get_reminder_scheduler(REMINDER_DB)
+    for plant, kind in scheduler.pop_alerts(username):
+        st.toast(f"{REMINDER_LABELS.get(kind, kind)}: time to {kind} {plant}!")
+
+    view = scheduler.user_view(username)
+    plants = set(view["plants"])
+    progress, remaining = calculate_progress(view["started"], view["interval"], time.time())
+    due_now = int(np.count_nonzero(remaining <= 0))
+    for index in view["order"][:REMINDER_PANEL_SIZE]:
+        plant, kind = view["plants"][index], view["kinds"][index]
+        st.progress(float(progress[index]) / 100)
+        status_col, done_col = st.columns([4, 1])
+        status_col.write(f"{REMINDER_LABELS.get(kind, kind)} ({plant}): {progress_message(remaining[index])}")
+        if done_col.button("Done ✅", key=f"reminder_done_{plant}_{kind}"):
+            scheduler.reset(username, plant, kind)
+            rerun_fragment()
+    summary = st.empty()  # Filled in last, so the time covers the whole panel
+
+    # Plants with their own cadences
+    with st.expander("🪴 Manage plants"):
+        with st.form(key="plant_form"):
+            plant_name = st.text_input("Plant or container", placeholder="e.g. Tomatoes, bed 3")
+            water_hours = st.number_input("Water every (hours)", min_value=1.0, value=24.0, step=1.0)
+            fertilizer_hours = st.number_input("Fertilize every (hours)", min_value=1.0, value=48.0, step=1.0)
+            if st.form_submit_button("Save plant") and plant_name:
+                scheduler.add_plant(username, plant_name, water_hours * 3600, fertilizer_hours * 3600)
+                rerun_fragment()
+        # Removal by name: a selectbox would send every plant to the browser on each refresh
+        with st.form(key="remove_plant_form"):
+            plant_to_remove = st.text_input("Remove a plant", placeholder="Name as shown in the reminders")
+            if st.form_submit_button("Remove plant") and plant_to_remove:
+                if plant_to_remove in plants:
+                    scheduler.remove_plant(username, plant_to_remove)
+                    rerun_fragment()
+                else:
+                    st.error(f"No plant named {plant_to_remove}.")
+
+    summary.caption(
+        f"{len(plants)} plants · {len(view['plants'])} reminders · {due_now} due now · "
+        f"panel computed in {(time.perf_counter() - panel_start) * 1000:.1f} ms"
+    )
+
+# Restore a login from the session cookie on a session's first run, and clear a cookie that no longer logs in
+if "session_checked" not in st.session_state:
+    st.session_state.session_checked = True
+    session_token = read_session_cookie()
+    token_user = session_token and get_user_store(USER_DB).check_token(session_token)
+    if token_user:
+        start_session(token_user)
+    elif session_token:
+        st.session_state.session_cookie = ""
+
+# Cookie changes from login and logout are written on the run after them, since those runs end in st.rerun()
+if "session_cookie" in st.session_state:
+    write_session_cookie(st.session_state.pop("session_cookie"))
 
 # Layout for Reminders and Login Form
 col1, col2 = st.columns([3, 1])  # Adjust column widths for layout
 
 # Reminders in the Left Column
 with col1:
-    st.write("🌿 Reminders")
-    water_progress, water_message = calculate_progress(st.session_state.water_start_time, 24 * 3600)  # 24 hours
-    fertilizer_progress, fertilizer_message = calculate_progress(st.session_state.fertilizer_start_time, 48 * 3600)  # 48 hours
-
-    # Placeholders for dynamic updates
-    water_placeholder = st.empty()
-    fertilizer_placeholder = st.empty()
-
-    # Update progress bars and messages
-    water_placeholder.progress(water_progress / 100)
-    water_placeholder.write(f"💧 Water Reminder: {water_message}")
-    fertilizer_placeholder.progress(fertilizer_progress / 100)
-    fertilizer_placeholder.write(f"🌱 Fertilizer Reminder: {fertilizer_message}")
+    reminders_panel()
 
 # Login Form in the Right Column
 with col2:
     if st.session_state.logged_in:
         st.success(f"Welcome, {st.session_state.username}!")
+        if st.button("Log out"):
+            get_user_store(USER_DB).revoke_tokens(st.session_state.username)
+            st.session_state.logged_in = False
+            st.session_state.username = ""
+            st.session_state.session_cookie = ""
+            st.rerun()
     else:
         with st.expander("🔑 Login"):
             username = st.text_input("Username", placeholder="Enter your username")
@@ -89,15 +314,21 @@ with col2:
             login_button = st.button("Login")
 
             if login_button:
-                if login(username, password):
+                result = login(username, password)
+                if result == "ok":
                     st.success(f"Welcome, {username}!")
                     st.rerun()  # Rerun the app to update the UI
+                elif result == "throttled":
+                    st.error("Too many failed logins. Please wait a few minutes and try again.")
                 else:
                     st.error("Login unsuccessful. Please check your credentials.")
 
 # Sidebar Navigation
 st.sidebar.title("🌿 Navigation")
-page = st.sidebar.radio("Go to", ["Home", "Chatbot", "Prompts", "Forum"])
+pages = ["Home", "Chatbot", "Prompts", "Forum"]
+if st.session_state.logged_in and st.session_state.username in ADMIN_USERS:
+    pages.append("Metrics")
+page = st.sidebar.radio("Go to", pages)
 
 # Home Page
 if page == "Home":
@@ -130,33 +361,66 @@ elif page == "Chatbot":
     st.title("🤖 Gardening Assistant Chatbot")
     st.markdown("Ask anything about **RoofTop gardening** and get instant responses powered by **Gemini Flash 2 AI**!")
 
-    # Initialize Gemini Model
-    def setup_gemini():
-        API_KEY = "API KEY"  # Replace with your actual API key
-        genai.configure(api_key=API_KEY)
-        model = genai.GenerativeModel("gemini-1.5-flash")  # Using Flash 2 (Free version)
-        return model
-
     try:
-        model = setup_gemini()
-
-        # Chat UI
-        with st.container():
-            st.write("### 🌱 Ask Your Gardening Question Below:")
-            user_input = st.text_area("Type your question here...", height=100)
-
-            # Submit button
-            if st.button("Generate Response 🌿"):
-                if user_input:
-                    with st.spinner("Thinking... 💡"):
+        # Reuse the cached chat model and count the setup time it saves this session
+        requested_at = time.time()
+        chat_model = get_chat_model(GEMINI_MODEL, API_KEY, GENERATION_CONFIG)
+        model = chat_model["model"]
+        if chat_model["built_at"] < requested_at:
+            st.session_state.model_time_saved += chat_model["build_time"]
+        st.caption(f"⏱️ Model setup saved this session: {st.session_state.model_time_saved * 1000:.1f} ms")
+        if hasattr(model, "describe"):  # Only the backend router reports its routing
+            st.caption(f"🧭 {model.describe()}")
+
+        # Chat UI, a fragment so typing and submitting never re-render the rest of the page
+        @timed_fragment("chatbot")
+        def chatbot_panel():
+            with st.container():
+                # Conversation so far, bounded by CHAT_HISTORY_TOKENS
+                chat_user = st.session_state.username or f"session:{st.session_state.chat_id}"
+                chat_store = get_chat_store(CHAT_DB)
+                window = chat_store.window(chat_user, CHAT_HISTORY_TOKENS)
+                if window["turns"]:
+                    with st.expander(f"🗨️ Conversation so far · {window['turn_count']} turns, ~{window['tokens']} tokens of history"):
+                        if window["summary"]:
+                            st.caption(f"Summary of earlier turns: {window['summary']}")
+                        for turn in window["turns"]:
+                            st.chat_message("user").write(turn["question"])
+                            st.chat_message("assistant").write(turn["answer"])
+                        if st.button("🧹 New conversation"):
+                            chat_store.clear(chat_user)
+                            rerun_fragment()
+
+                st.write("### 🌱 Ask Your Gardening Question Below:")
+                user_input = st.text_area("Type your question here...", height=100)
+                stream_mode = st.toggle("Stream response as it is generated ⚡", value=True)
+
+                # Submit button
+                if st.button("Generate Response 🌿"):
+                    if user_input:
                         try:
-                            response = model.generate_content(user_input)
-                            st.subheader("🤖 AI Response:")
-                            st.markdown(f"**{response.text}**")
+                            response = {}
+                            if window["turns"] and time.time() - window["last_at"] > CHAT_THREAD_IDLE:
+                                chat_store.start_thread(chat_user)  # Picked up after a long pause: a new question, not a follow-up
+                                window = chat_store.window(chat_user, CHAT_HISTORY_TOKENS)
+                            if window["turns"]:
+                                answer_follow_up(model, user_input, window, stream_mode, response)
+                            else:
+                                answer_text_question(model, user_input, stream_mode, response)
+                            record_chat_turn(model, chat_store, chat_user, user_input, response)
+                        except TimeoutError:
+                            get_metrics().count("errors", page="chatbot", kind="TimeoutError")
+                            st.error("⏳ The assistant is busy right now. Please try again in a moment.")
                         except Exception as e:
+                            logger.exception("Chatbot request failed")
+                            get_metrics().count("errors", page="chatbot", kind=type(e).__name__)
                             st.error("⚠️ Error: Could not process your request. Please check your API key and try again.")
-                else:
-                    st.warning("⚠️ Please enter a question before submitting.")
+                        show_dispatcher_stats()
+                    else:
+                        st.warning("⚠️ Please enter a question before submitting.")
+
+        chatbot_panel()
+
     except Exception as e:
         st.error(f"⚠️ Error initializing the Chatbot: {e}. Please ensure your Gemini API key is correctly set.")
 
@@ -165,147 +429,38 @@ elif page == "Prompts":
     st.title("📝 RoofTop Gardening Prompts")
     st.markdown("Explore a comprehensive list of prompts to guide your rooftop gardening journey.")
 
-    # Organized Prompts
-    st.header("🌿 How to Design Rooftop Gardening")
-    st.markdown("""
-    1. How to Design Rooftop Gardening  
-    2. What are the key considerations for designing a rooftop garden?  
-    3. How can I create a layout for my rooftop garden?  
-    4. What types of containers are best for rooftop gardening?  
-    5. How do I choose the right plants for my rooftop garden design?  
-    6. What are the best materials for building raised beds on a rooftop?  
-    7. How can I incorporate vertical gardening into my rooftop design?  
-    8. What are some creative ways to use space in a small rooftop garden?  
-    9. How can I design a rooftop garden that is aesthetically pleasing?  
-    10. What are the best practices for ensuring proper drainage in a rooftop garden?  
-    11. How can I create shaded areas in my rooftop garden?  
-    """)
-
-    st.header("🌱 Which Crops to Grow in Which Season")
-    st.markdown("""
-    12. What vegetables can I grow in the spring on my rooftop?  
-    13. Which herbs thrive in summer rooftop gardens?  
-    14. What are the best fall crops for rooftop gardening?  
-    15. How can I grow winter vegetables in a rooftop garden?  
-    16. What are the best fruits to grow in a rooftop garden by season?  
-    17. How do I choose companion plants for my rooftop garden?  
-    18. What are the best crops for container gardening on rooftops?  
-    19. How can I extend the growing season in my rooftop garden?  
-    20. What are the best microgreens to grow indoors or on a rooftop?  
-    21. How do seasonal changes affect plant selection for rooftop gardens?  
-    """)
-
-    st.header("🌿 Proper Manure and Preparation Methods")
-    st.markdown("""
-    22. What types of manure are best for rooftop gardening?  
-    23. How do I prepare manure for use in my rooftop garden?  
-    24. What is the difference between compost and manure?  
-    25. How can I make my own organic manure at home?  
-    26. What are the benefits of using manure in rooftop gardening?  
-    27. How do I apply manure to my rooftop garden?  
-    28. What is the proper ratio of manure to soil for container gardening?  
-    29. How can I tell if my manure is ready for use?  
-    30. What precautions should I take when using manure in my garden?  
-    31. How can I store manure safely for future use?  
-    """)
-
-    st.header("💧 Techniques for Manure and Water Management")
-    st.markdown("""
-    32. What are the best techniques for composting on a rooftop?  
-    33. How can I integrate rainwater harvesting into my rooftop garden?  
-    34. What are the benefits of using drip irrigation in rooftop gardening?  
-    35. How do I set up a simple irrigation system for my rooftop garden?  
-    36. What are the best practices for watering plants in containers?  
-    37. How can I use greywater in my rooftop garden?  
-    38. What are the signs of overwatering in rooftop plants?  
-    39. How can I create a self-watering system for my rooftop garden?  
-    40. What are the best times of day to water rooftop plants?  
-    41. How can I prevent water runoff from my rooftop garden?  
-    """)
-
-    st.header("🐛 Pest Management in Rooftop Gardens")
-    st.markdown("""
-    42. What are common pests in rooftop gardens and how can I manage them?  
-    43. How can I use companion planting to deter pests?  
-    44. What natural pest control methods are effective for rooftop gardens?  
-    45. How do I identify signs of pest infestations in my plants?  
-    46. What are the best organic pesticides for rooftop gardening?  
-    47. How can I attract beneficial insects to my rooftop garden?  
-    48. What are the best practices for maintaining plant health to prevent pests?  
-    49. How can I create barriers to protect my rooftop garden from pests?  
-    50. What role do birds play in pest management on rooftops?  
-    51. How can I use traps to control pests in my rooftop garden?  
-    """)
-
-    st.header("🌱 Soil Preparation and Maintenance")
-    st.markdown("""
-    52. What is the best soil mix for rooftop gardening?  
-    53. How do I test the soil quality in my rooftop garden?  
-    54. What amendments can I add to improve rooftop garden soil?  
-    55. How often should I refresh the soil in my containers?  
-    56. What are the signs of nutrient deficiency in rooftop plants?  
-    57. How can I improve drainage in my rooftop garden soil?  
-    58. What are the best practices for mulching in rooftop gardens?  
-    59. How do I prevent soil erosion on my rooftop garden?  
-    60. What is the importance of soil pH in rooftop gardening?  
-    61. How can I create a soil management plan for my rooftop garden?  
-    """)
-
-    st.header("🌍 Sustainable Practices in Rooftop Gardening")
-    st.markdown("""
-    62. How can I make my rooftop garden more sustainable?  
-    63. What are the benefits of using organic fertilizers in rooftop gardening?  
-    64. How can I reduce waste in my rooftop garden?  
-    65. What are the best practices for recycling materials in rooftop gardening?  
-    66. How can I create a pollinator-friendly rooftop garden?  
-    67. What are the benefits of using native plants in rooftop gardens?  
-    68. How can I incorporate permaculture principles into my rooftop garden?  
-    69. What are the best practices for sustainable water management in rooftop gardening?  
-    70. How can I create a habitat for wildlife in my rooftop garden?  
-    71. What are the benefits of using cover crops in rooftop gardening?  
-    """)
-
-    st.header("🍂 Seasonal Care and Maintenance")
-    st.markdown("""
-    72. How do I prepare my rooftop garden for winter?  
-    73. What are the best practices for spring planting in rooftop gardens?  
-    74. How can I protect my rooftop garden from summer heat?  
-    75. What fall maintenance tasks should I perform in my rooftop garden?  
-    76. How do I manage plant growth during seasonal transitions?  
-    77. What are the signs that my rooftop garden needs seasonal care?  
-    78. How can I extend the growing season with season extenders?  
-    79. What are the best practices for harvesting crops from a rooftop garden?  
-    80. How do I clean and store gardening tools for seasonal changes?  
-    81. What are the benefits of crop rotation in rooftop gardening?  
-    """)
-
-    st.header("👥 Community and Education")
-    st.markdown("""
-    82. How can I get involved in community rooftop gardening projects?  
-    83. What resources are available for learning about rooftop gardening?  
-    84. How can I share my rooftop gardening experiences with others?  
-    85. What are the benefits of joining a rooftop gardening club?  
-    86. How can I teach children about rooftop gardening?  
-    87. What workshops or classes are available for rooftop gardening enthusiasts?  
-    88. How can I connect with local gardeners for advice and support?  
-    89. What are the best online forums for rooftop gardening discussions?  
-    90. How can I document my rooftop gardening journey?  
-    91. What are the benefits of collaborating with local schools on gardening projects?  
-    """)
-
-    st.header("🚀 Innovations in Rooftop Gardening")
-    st.markdown("""
-    92. What are the latest trends in rooftop gardening technology?  
-    93. How can I use smart gardening tools in my rooftop garden?  
-    94. What are the benefits of hydroponics in rooftop gardening?  
-    95. How can I incorporate aquaponics into my rooftop garden?  
-    96. What are the advantages of using green roofs in urban areas?  
-    97. How can I utilize solar energy for my rooftop garden?  
-    98. What are the best apps for managing a rooftop garden?  
-    99. How can I use sensors to monitor plant health in my rooftop garden?  
-    100. What innovative materials can I use for rooftop gardening?  
-    101. How can I create a sustainable rooftop garden that adapts to climate change?  
-    """)
+    # Organized Prompts, served from the answer store when pre-warmed
+    answer_store = get_prompt_answer_store(PROMPT_ANSWER_DB)
+    prewarm_job = get_prewarm_job()
+    stored_count = answer_store.count()
+    st.caption(f"⚡ {stored_count} of {len(PROMPTS)} answers ready for instant lookup")
+    if prewarm_job["thread"] is not None and prewarm_job["thread"].is_alive():
+        st.info(f"Pre-warming answers... {prewarm_job['done']} done, {prewarm_job['failed']} failed of {prewarm_job['total']}")
+    elif stored_count < len(PROMPTS) and st.button("⚡ Pre-warm All Answers"):
+        start_prewarm(get_chat_model(GEMINI_MODEL, API_KEY, GENERATION_CONFIG)["model"], answer_store, prewarm_job)
+        st.rerun()
+
+    current_category = None
+    for prompt in PROMPTS:
+        if prompt.category != current_category:
+            current_category = prompt.category
+            st.header(current_category)
+        if st.button(f"{prompt.id}. {prompt.text}", key=f"prompt_{prompt.id}"):
+            st.session_state.selected_prompt = prompt.id
+        if st.session_state.selected_prompt == prompt.id:
+            answer = answer_store.get(prompt.id)
+            if answer is None:
+                with st.spinner("Thinking... 💡"):
+                    try:
+                        model = get_chat_model(GEMINI_MODEL, API_KEY, GENERATION_CONFIG)["model"]
+                        answer = answer_question(model, prompt.text)["text"]
+                        answer_store.put(prompt.id, answer)
+                    except Exception as e:
+                        logger.exception("Prompt answer failed")
+                        get_metrics().count("errors", page="prompts", kind=type(e).__name__)
+                        st.error(f"⚠️ Error: {e}. Please check your API key and try again.")
+            if answer is not None:
+                st.markdown(f"**{answer}**")
 
 # Forum Page
 elif page == "Forum":
@@ -316,6 +471,61 @@ elif page == "Forum":
     def format_datetime(dt):
         return dt.strftime("%Y-%m-%d %H:%M:%S")
 
+    forum_store = get_forum_store(FORUM_DB)
+
+    # Each thread is its own fragment: replying or opening replies reruns only that thread
+    @timed_fragment("forum thread")
+    def forum_thread(post_id):
+        post = forum_store.get_post(post_id)
+        widget_count = 0
+        with st.container():
+            st.markdown(f"**📝 {post.user} says:**")
+            st.info(post.content)
+            st.caption(f"Posted on: {format_datetime(post.timestamp)}")
+            widget_count += 3
+
+            # Reply button to toggle reply form
+            reply_key = f"reply_button_{post_id}"
+            if st.button("Reply", key=reply_key):
+                st.session_state.replying ^= {post_id}
+                rerun_fragment()
+            widget_count += 1
+
+            # Display reply form if the reply button is clicked
+            if post_id in st.session_state.replying:
+                with st.form(key=f"reply_form_{post_id}"):
+                    reply_name = st.text_input("Your Name", placeholder="Enter your name", key=f"reply_name_{post_id}")
+                    reply_content = st.text_area("Your Reply...", height=50, key=f"reply_content_{post_id}")
+                    reply_submit_button = st.form_submit_button("Submit Reply")
+
+                    if reply_submit_button and reply_name and reply_content:
+                        forum_store.add_reply(post_id, reply_name, reply_content, datetime.now())
+                        st.session_state.replying.discard(post_id)  # Hide reply form after submission
+                        st.session_state.showing_replies.add(post_id)
+                        st.success("✅ Your reply has been added!")
+                        rerun_fragment()
+                widget_count += 4
+
+            # Replies stay collapsed and are only loaded when the thread is opened
+            if post.reply_count:
+                showing = post_id in st.session_state.showing_replies
+                label = "Hide replies" if showing else f"💬 Show replies ({post.reply_count})"
+                if st.button(label, key=f"replies_button_{post_id}"):
+                    st.session_state.showing_replies ^= {post_id}
+                    rerun_fragment()
+                widget_count += 1
+                if showing:
+                    st.write("**Replies:**")
+                    for reply in forum_store.list_replies(post_id, FORUM_REPLY_LIMIT):
+                        st.markdown(f"**🗨️ {reply.user} replied:**")
+                        st.info(reply.content)
+                        st.caption(f"Replied on: {format_datetime(reply.timestamp)}")
+                        widget_count += 3
+                    if post.reply_count > FORUM_REPLY_LIMIT:
+                        st.caption(f"Showing the first {FORUM_REPLY_LIMIT} of {post.reply_count} replies.")
+                    widget_count += 2
+        return widget_count
+
     # Form to submit a new discussion
     with st.form(key="forum_form"):
         user_name = st.text_input("Your Name", placeholder="Enter your name")
@@ -323,47 +533,97 @@ elif page == "Forum":
         submit_button = st.form_submit_button("Post")
 
         if submit_button and user_name and post_content:
-            timestamp = datetime.now()
-            new_post = {"user": user_name, "content": post_content, "replies": [], "timestamp": timestamp}
-            st.session_state.forum_data.append(new_post)
+            post_id = forum_store.add_post(user_name, post_content, datetime.now())
+            index_entries([("post", str(post_id), post_content, None)])
+            st.session_state.forum_cursors = []  # Jump back to the newest page to show the post
             st.success("✅ Your post has been added!")
             st.rerun()
 
     st.write("### 🌿 Community Discussions")
-    if st.session_state.forum_data:
-        for idx, post in enumerate(st.session_state.forum_data):
-            with st.container():
-                st.markdown(f"**📝 {post['user']} says:**")
-                st.info(post["content"])
-                st.caption(f"Posted on: {format_datetime(post['timestamp'])}")
-
-                # Reply button to toggle reply form
-                reply_key = f"reply_button_{idx}"
-                if st.button("Reply", key=reply_key):
-                    st.session_state.replying[idx] = not st.session_state.replying.get(idx, False)
-                    st.rerun()
-
-                # Display reply form if the reply button is clicked
-                if st.session_state.replying.get(idx, False):
-                    with st.form(key=f"reply_form_{idx}"):
-                        reply_name = st.text_input("Your Name", placeholder="Enter your name", key=f"reply_name_{idx}")
-                        reply_content = st.text_area("Your Reply...", height=50, key=f"reply_content_{idx}")
-                        reply_submit_button = st.form_submit_button("Submit Reply")
-
-                        if reply_submit_button and reply_name and reply_content:
-                            reply_timestamp = datetime.now()
-                            new_reply = {"user": reply_name, "content": reply_content, "timestamp": reply_timestamp}
-                            st.session_state.forum_data[idx]["replies"].append(new_reply)
-                            st.session_state.replying[idx] = False  # Hide reply form after submission
-                            st.success("✅ Your reply has been added!")
-                            st.rerun()
-
-                # Display replies
-                if post["replies"]:
-                    st.write("**Replies:**")
-                    for reply in post["replies"]:
-                        st.markdown(f"**🗨️ {reply['user']} replied:**")
-                        st.info(reply["content"])
-                        st.caption(f"Replied on: {format_datetime(reply['timestamp'])}")
 
-# Real-time timer updates
+    # Search box, answered from the full-text index instead of the rendered list
+    search_query = st.text_input("🔍 Search the forum", placeholder="e.g. tomato, drip irrigation, pests")
+    if search_query.strip():
+        with get_metrics().span("forum_search"):
+            search_start = time.perf_counter()
+            results = forum_store.search(search_query, FORUM_SEARCH_LIMIT)
+        st.caption(f"{len(results)} results in {(time.perf_counter() - search_start) * 1000:.1f} ms")
+        for result in results:
+            verb = "says" if result["kind"] == "post" else "replied"
+            st.markdown(f"**{'📝' if result['kind'] == 'post' else '🗨️'} {result['user']} {verb}:** {result['snippet']}")
+            st.caption(f"On: {format_datetime(result['timestamp'])}")
+        st.divider()
+
+    # Keyset pagination, newest first: the cursor stack holds the post id each older page starts below
+    render_start = time.perf_counter()
+    widget_count = 0
+    before_id = st.session_state.forum_cursors[-1] if st.session_state.forum_cursors else None
+    posts, has_older = forum_store.list_posts(before_id, FORUM_PAGE_SIZE)
+    for post in posts:
+        widget_count += forum_thread(post.id)
+
+    # Page navigation
+    newer_col, older_col = st.columns(2)
+    with newer_col:
+        if st.session_state.forum_cursors and st.button("⬅️ Newer posts"):
+            st.session_state.forum_cursors.pop()
+            st.rerun()
+    with older_col:
+        if has_older and st.button("Older posts ➡️"):
+            st.session_state.forum_cursors.append(posts[-1].id)
+            st.rerun()
+    render_time = time.perf_counter() - render_start
+    get_metrics().observe("forum_render", render_time)
+    st.caption(
+        f"Page {len(st.session_state.forum_cursors) + 1} · {len(posts)} posts · "
+        f"{widget_count} widgets rendered in {render_time * 1000:.1f} ms"
+    )
+
+# Metrics Page, for admins only
+elif page == "Metrics":
+    st.title("📊 Metrics")
+    st.markdown("Live timings of the hot paths in this process, with the Prometheus text export.")
+    if get_metrics().port:
+        st.caption(f"Prometheus can scrape this process on port {get_metrics().port}.")
+    # Rebuilds the chat model and resets the router for every session in this process
+    if st.button("🔄 Reload Model"):
+        get_chat_model.clear()
+        st.rerun()
+
+    @timed_fragment("metrics", run_every=METRICS_REFRESH_SECONDS)
+    def metrics_panel():
+        metrics = get_metrics()
+        footprints = get_session_footprints().stats
+        st.caption(
+            f"🧠 {footprints['sessions']} sessions in the last hour · state per session: "
+            f"mean {footprints['mean_bytes'] / 1024:.1f} KiB, max {footprints['max_bytes'] / 1024:.1f} KiB · "
+            f"shared prompt catalog {deep_size(PROMPTS) / 1024:.0f} KiB, forum cache {len(get_forum_store(FORUM_DB).cache)} entries"
+        )
+        st.subheader("⏱️ Spans")
+        st.dataframe(metrics.percentiles(), hide_index=True)
+        st.subheader("🧾 Prometheus export")
+        export = metrics.prometheus()
+        st.download_button("⬇️ Download metrics.txt", export, file_name="metrics.txt")
+        st.code(export, language="text")
+
+    metrics_panel()
+
+# Rerun cost this session: full script runs versus fragment reruns
+record_run("full page", script_started)
+session_bytes = deep_size(dict(st.session_state.items()))
+get_session_footprints().record(st.session_state.chat_id, session_bytes)
+st.sidebar.caption(
+    f"🧠 Session state {session_bytes / 1024:.1f} KiB · ⏱️ Reruns: "
+    + " · ".join(f"{scope} {stats['runs']}× (last {stats['last'] * 1000:.0f} ms)" for scope, stats in st.session_state.rerun_stats.items())
+)
+
+# Cold start of this process and the heavy imports it has paid for so far
+startup = get_startup_report()
+if startup["first_run"] is None:
+    startup["first_run"] = {"page": page, "seconds": time.perf_counter() - script_started}
+with st.sidebar.expander("🚀 Startup"):
+    st.caption(f"Cold start: {startup['first_run']['page']} page in {startup['first_run']['seconds'] * 1000:.0f} ms")
+    for module_name, seconds in sorted(startup["imports"].items(), key=lambda item: -item[1]):
+        st.caption(f"import {module_name}: {seconds * 1000:.0f} ms")
+    if not startup["imports"]:
+        st.caption("No heavy modules imported yet")
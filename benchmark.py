@@ -0,0 +1,421 @@
+# Headless benchmark for the Streamlit apps, driven by Streamlit's AppTest against the fake LLM backend.
+# Runs offline: no API key, network or model download is needed, and all databases live in a temporary directory.
+#
+#   python benchmark.py                                   # Rooftop.py with the default settings
+#   python benchmark.py --app Rooftop+Aydio.py --runs 50  # the audio variant (audio uploads are not driven)
+#   python benchmark.py --output baseline.json            # save the results
+#   python benchmark.py --baseline baseline.json          # exit 1 when an interaction's p95 regresses
+#   python benchmark.py --sessions 200                    # also report per-session state size with 200 sessions open
+#   python benchmark.py --workers 4                       # 4 processes on the same databases, as in scale-out mode
+#   python benchmark.py --logins 64                       # also measure 64 logins from concurrent processes
+#   python benchmark.py --search-posts 100000             # also time forum searches over 100k seeded posts
+#   python benchmark.py --audio-requests 32               # also compare unbatched and batched audio throughput
+#   python benchmark.py --cold-starts 5                   # also time fresh processes with eager and lazy imports
+#
+# Each interaction reports p50/p95 latency, the full script runs it completed and the peak traced Python memory.
+# Latency is timed with tracemalloc off, since tracing slows every allocation; peak memory comes from a separate,
+# shorter pass (--memory-runs) with it on.
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import numpy as np
+
+# Seed the forum with a large history before the app opens it; the app adds its indexes and search table on start
+def seed_forum(db_path, posts, replies_per_post):
+    db = sqlite3.connect(db_path)
+    with db:
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS posts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user TEXT NOT NULL,
+                content TEXT NOT NULL,
+                timestamp TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS replies (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                post_id INTEGER NOT NULL REFERENCES posts(id),
+                user TEXT NOT NULL,
+                content TEXT NOT NULL,
+                timestamp TEXT NOT NULL
+            );
+        """)
+        start = datetime.now() - timedelta(days=365)
+        db.executemany(
+            "INSERT INTO posts (user, content, timestamp) VALUES (?, ?, ?)",
+            (
+                (f"gardener{i % 50}", f"Post {i} about tomato, basil and drip irrigation on the roof", (start + timedelta(minutes=i)).isoformat())
+                for i in range(posts)
+            ),
+        )
+        db.executemany(
+            "INSERT INTO replies (post_id, user, content, timestamp) VALUES (?, ?, ?, ?)",
+            (
+                (post_id, f"gardener{(post_id + j) % 50}", f"Reply {j} on post {post_id}: try mulch", (start + timedelta(minutes=post_id, seconds=j)).isoformat())
+                for post_id in range(1, posts + 1)
+                for j in range(replies_per_post)
+            ),
+        )
+    db.close()
+
+def by_label(elements, label):
+    return next(element for element in elements if element.label == label)
+
+def full_runs(at):
+    return at.session_state["rerun_stats"].get("full page", {}).get("runs", 0) if "rerun_stats" in at.session_state else 0
+
+# Time one interaction: `action` takes the AppTest, changes widgets and returns it after .run().
+# Its peak memory is recorded too while tracemalloc is tracing.
+def measure(results, name, at, action):
+    runs_before = full_runs(at)
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    at = action(at)
+    elapsed = time.perf_counter() - start
+    if at.exception:
+        raise RuntimeError(f"{name} raised: {at.exception[0].message}")
+    results.setdefault(name, {"latency": [], "reruns": [], "peak_memory": []})
+    results[name]["latency"].append(elapsed)
+    results[name]["reruns"].append(full_runs(at) - runs_before)
+    if tracing:
+        results[name]["peak_memory"].append(tracemalloc.get_traced_memory()[1])
+    return at
+
+def login(at, user):
+    by_label(at.text_input, "Username").set_value(user)
+    by_label(at.text_input, "Password").set_value("rooftop")
+    return by_label(at.button, "Login").click().run()
+
+def go_to(at, page):
+    return at.sidebar.radio[0].set_value(page).run()
+
+def ask_chatbot(at, question):
+    by_label(at.text_area, "Type your question here...").set_value(question)
+    return by_label(at.button, "Generate Response 🌿").click().run()
+
+def add_post(at, content):
+    by_label(at.text_input, "Your Name").set_value("benchmark")
+    by_label(at.text_area, "Share your thoughts or ask a question...").set_value(content)
+    return by_label(at.button, "Post").click().run()
+
+def reply_to_newest(at, content):
+    post_id = int(next(button.key for button in at.button if button.key and button.key.startswith("reply_button_")).rsplit("_", 1)[1])
+    at = at.button(key=f"reply_button_{post_id}").click().run()
+    at.text_input(key=f"reply_name_{post_id}").set_value("benchmark")
+    at.text_area(key=f"reply_content_{post_id}").set_value(content)
+    return by_label(at.button, "Submit Reply").click().run()
+
+def run_benchmark(args):
+    from streamlit.testing.v1 import AppTest
+
+    results = {}
+    for i in range(args.runs):
+        at = AppTest.from_file(args.app, default_timeout=args.timeout)
+        at = measure(results, "cold page load" if i == 0 else "page load", at, lambda at: at.run())
+        at = measure(results, "login", at, lambda at: login(at, "sanketh"))
+        at = measure(results, "open chatbot", at, lambda at: go_to(at, "Chatbot"))
+        at = measure(results, "chatbot submit", at, lambda at: ask_chatbot(at, f"How often should I water tomato plant number {i}?"))
+        at = measure(results, "open forum", at, lambda at: go_to(at, "Forum"))
+        at = measure(results, "forum post", at, lambda at: add_post(at, f"Benchmark post {i}: my chillies are wilting"))
+        at = measure(results, "forum reply", at, lambda at: reply_to_newest(at, f"Benchmark reply {i}: water in the evening"))
+        at = measure(results, "open prompts", at, lambda at: go_to(at, "Prompts"))
+        at = measure(results, "prompt answer", at, lambda at: at.button(key=f"prompt_{i % 101 + 1}").click().run())
+    return results
+
+# Open many logged-in sessions on the forum, then read the app's own session-size gauges from the Metrics page
+def session_footprint(args):
+    from streamlit.testing.v1 import AppTest
+
+    sessions = []
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    for _ in range(args.sessions):
+        at = login(AppTest.from_file(args.app, default_timeout=args.timeout).run(), "sanketh")
+        sessions.append(go_to(at, "Forum"))
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    exposition = go_to(sessions[-1], "Metrics").code[0].value
+    gauges = dict(re.findall(r"^rooftop_sessions_(\w+) ([\d.e+-]+)$", exposition, re.M))
+    return {
+        "sessions": int(float(gauges.get("sessions", 0))),
+        "mean_kib": float(gauges.get("mean_bytes", 0)) / 1024,
+        "max_kib": float(gauges.get("max_bytes", 0)) / 1024,
+        "peak_memory_mib": peak / 2**20,
+        "seconds": elapsed,
+    }
+
+# The memory pass: args.memory_runs sessions with tracemalloc on, whose latencies are discarded
+def traced_benchmark(args):
+    tracemalloc.start()
+    try:
+        return run_benchmark(argparse.Namespace(**{**vars(args), "runs": args.memory_runs}))
+    finally:
+        tracemalloc.stop()
+
+# Log one fresh session in per index in `indexes` and return each login click's latency, password check included
+def sign_in(args, indexes):
+    from streamlit.testing.v1 import AppTest
+
+    users = ["sanketh", "nikhil", "karthik", "shiva"]
+    latencies = []
+    for i in indexes:
+        at = AppTest.from_file(args.app, default_timeout=args.timeout).run()
+        start = time.perf_counter()
+        at = login(at, users[i % len(users)])
+        latencies.append(time.perf_counter() - start)
+        if at.exception or not at.session_state["logged_in"]:
+            raise RuntimeError(f"login {i} failed")
+    return latencies
+
+# Log `args.logins` sessions in from `args.login_concurrency` processes at once against one user store, as users
+# arriving together at several workers would (AppTest cannot run two sessions at once in one process).
+def login_throughput(args):
+    concurrency = min(args.login_concurrency, args.logins)
+    start = time.perf_counter()
+    with multiprocessing.get_context("spawn").Pool(concurrency) as pool:
+        parts = pool.starmap(sign_in, [(args, range(k, args.logins, concurrency)) for k in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies = [latency for part in parts for latency in part]
+    return {
+        "logins": args.logins,
+        "per_second": args.logins / elapsed,
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "p95_ms": float(np.percentile(latencies, 95) * 1000),
+    }
+
+SEARCH_QUERIES = ["tomato", "to", "drip irrigation", "post 4242", "aphids"]  # Common, prefix, phrase, rare, no match
+
+# Time ForumStore.search directly on a forum of `args.search_posts` posts, so the figures are the query's own
+def search_latency(args, db_path):
+    from rooftop_core import FORUM_SEARCH_LIMIT, ForumStore
+
+    seed_forum(db_path, args.search_posts, 0)
+    start = time.perf_counter()
+    store = ForumStore(db_path)  # Builds the full-text index over the seeded posts
+    build = time.perf_counter() - start
+    latencies = {}
+    for query in SEARCH_QUERIES:
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            store.search(query, FORUM_SEARCH_LIMIT)
+            latencies.setdefault(query, []).append(time.perf_counter() - start)
+    return {
+        "posts": args.search_posts,
+        "index_seconds": build,
+        "queries": {
+            query: {"p50_ms": float(np.percentile(samples, 50) * 1000), "p95_ms": float(np.percentile(samples, 95) * 1000)}
+            for query, samples in latencies.items()
+        },
+    }
+
+# Send `args.audio_requests` uploads at once, every other one streamed, through the audio batcher in front of the
+# fake audio model, with batches of one and of AUDIO_BATCH_SIZE. Returns uploads answered per second for each.
+def audio_throughput(args):
+    from rooftop_audio import AUDIO_BATCH_SIZE, AUDIO_BATCH_WINDOW, AUDIO_SAMPLE_RATE, AudioBatcher, FakeAudioModel
+    from rooftop_core import FAKE_LLM_TOKENS
+
+    audio = np.zeros(5 * AUDIO_SAMPLE_RATE, dtype=np.float32)
+    rates = {}
+    for batch_size in (1, AUDIO_BATCH_SIZE):
+        batcher = AudioBatcher(FakeAudioModel(args.latency, args.token_rate, FAKE_LLM_TOKENS).generate_batch, batch_size, AUDIO_BATCH_WINDOW)
+        with ThreadPoolExecutor(args.audio_requests) as pool:
+            start = time.perf_counter()
+            list(pool.map(lambda i: "".join(batcher.submit(audio, i % 2 == 0)), range(args.audio_requests)))
+            rates[batch_size] = args.audio_requests / (time.perf_counter() - start)
+    return rates
+
+# Modules the scripts imported at the top before they were loaded on first use through heavy_import()
+EAGER_IMPORTS = ["google.generativeai", "librosa", "soundfile", "soxr", "torch", "transformers"]
+
+# A fresh interpreter that imports the modules named after the app path, as the eager script did, then runs
+# the app once to its Home page
+COLD_START = """
+import importlib, sys
+for name in sys.argv[2:]:
+    importlib.import_module(name)
+from streamlit.testing.v1 import AppTest
+sys.exit(1 if AppTest.from_file(sys.argv[1], default_timeout=60).run().exception else 0)
+"""
+
+def installed(name):
+    try:
+        return importlib.util.find_spec(name) is not None
+    except ModuleNotFoundError:  # A missing parent package, e.g. google
+        return False
+
+# Cold start of a new worker on the Home page, timed as the wall time of a fresh process, with the heavy modules
+# loaded lazily (as the app does now) and eagerly. Modules that are not installed cannot be preloaded, so the
+# eager figure is then a lower bound.
+def cold_start(args):
+    preload = [name for name in EAGER_IMPORTS if installed(name)]
+    seconds = {"lazy": [], "eager": []}
+    for _ in range(args.cold_starts):
+        for mode, modules in (("lazy", []), ("eager", preload)):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", COLD_START, args.app, *modules], check=True, capture_output=True)
+            seconds[mode].append(time.perf_counter() - start)
+    return {
+        "lazy_ms": float(np.median(seconds["lazy"]) * 1000),
+        "eager_ms": float(np.median(seconds["eager"]) * 1000),
+        "preloaded": preload,
+        "missing": [name for name in EAGER_IMPORTS if name not in preload],
+    }
+
+# Run the benchmark in `workers` processes at once against the same databases, as separate Streamlit workers
+# would, and merge their samples. Returns the merged results and completed interactions per second.
+def run_workers(args, workers):
+    os.environ["ROOFTOP_WORKERS"] = str(workers)
+    start = time.perf_counter()
+    with multiprocessing.get_context("spawn").Pool(workers) as pool:
+        parts = pool.map(run_benchmark, [args] * workers)
+    elapsed = time.perf_counter() - start
+    results = {}
+    for part in parts:
+        for name, figures in part.items():
+            merged = results.setdefault(name, {"latency": [], "reruns": [], "peak_memory": []})
+            for key, values in figures.items():
+                merged[key].extend(values)
+    return results, sum(len(figures["latency"]) for figures in results.values()) / elapsed
+
+def summarize(results):
+    return {
+        name: {
+            "p50_ms": float(np.percentile(figures["latency"], 50) * 1000),
+            "p95_ms": float(np.percentile(figures["latency"], 95) * 1000),
+            "reruns": float(np.mean(figures["reruns"])),
+            "peak_memory_mib": float(max(figures["peak_memory"]) / 2**20) if figures["peak_memory"] else None,
+            "samples": len(figures["latency"]),
+        }
+        for name, figures in results.items()
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the RoofTop Gardening app headlessly with a fake LLM.")
+    parser.add_argument("--app", default="Rooftop.py")
+    parser.add_argument("--runs", type=int, default=20, help="Sessions to drive through every interaction")
+    parser.add_argument("--memory-runs", type=int, default=3, help="Sessions driven again with tracemalloc on for peak memory; 0 skips")
+    parser.add_argument("--forum-posts", type=int, default=5000, help="Posts seeded into the forum before the run")
+    parser.add_argument("--forum-replies", type=int, default=5, help="Replies seeded under each post")
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds before the fake model's first token")
+    parser.add_argument("--token-rate", type=float, default=200.0, help="Fake tokens per second")
+    parser.add_argument("--embedding-model", default="hash", help="Embedding model for the semantic index; \"hash\" needs no download")
+    parser.add_argument("--sessions", type=int, default=0, help="Also open this many sessions and report their state size")
+    parser.add_argument("--workers", type=int, default=1, help="Processes driving sessions at once; above 1, throughput is compared with one process")
+    parser.add_argument("--logins", type=int, default=0, help="Also log this many sessions in concurrently and report login throughput")
+    parser.add_argument("--login-concurrency", type=int, default=8, help="Processes logging sessions in at once for --logins")
+    parser.add_argument("--search-posts", type=int, default=0, help="Also time forum searches over a forum of this many posts")
+    parser.add_argument("--audio-requests", type=int, default=0, help="Also send this many audio uploads at once, unbatched and batched")
+    parser.add_argument("--cold-starts", type=int, default=0, help="Also start this many fresh processes each with eager and lazy imports")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Seconds AppTest waits for one script run")
+    parser.add_argument("--output", help="Write the summary to this JSON file")
+    parser.add_argument("--baseline", help="Compare against a summary written earlier with --output")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed p95 slowdown against the baseline, as a fraction")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="rooftop-bench-", ignore_cleanup_errors=True) as workdir:
+        os.environ.update({
+            "ROOFTOP_LLM_BACKEND": "fake",
+            "ROOFTOP_FAKE_LATENCY": str(args.latency),
+            "ROOFTOP_FAKE_TOKEN_RATE": str(args.token_rate),
+            "ROOFTOP_GENERATION_RATE": "1000",  # Measure the app, not the upstream rate limit
+            "ROOFTOP_FORUM_DB": os.path.join(workdir, "forum.db"),
+            "ROOFTOP_REMINDER_DB": os.path.join(workdir, "reminders.db"),
+            "ROOFTOP_ANSWER_DB": os.path.join(workdir, "prompt_answers.db"),
+            "ROOFTOP_CACHE_DB": os.path.join(workdir, "response_cache.db"),
+            "ROOFTOP_CHAT_DB": os.path.join(workdir, "chats.db"),
+            "ROOFTOP_USER_DB": os.path.join(workdir, "users.db"),
+            "ROOFTOP_SEMANTIC_DIR": os.path.join(workdir, "semantic_index"),
+            "ROOFTOP_EMBEDDING_MODEL": args.embedding_model,
+        })
+        seed_forum(os.environ["ROOFTOP_FORUM_DB"], args.forum_posts, args.forum_replies)
+
+        # Process pools go first: once AppTest has run in this process it has replaced __main__,
+        # and the pools could no longer look up the functions they are given
+        logins = login_throughput(args) if args.logins else None
+        startup = cold_start(args) if args.cold_starts else None
+        throughput = None
+        if args.workers > 1:
+            _, single = run_workers(args, 1)
+            results, combined = run_workers(args, args.workers)
+            throughput = (single, combined)
+        else:
+            results = run_benchmark(args)
+        # Runs after the timed pass, so "cold page load" is only cold in the figures that are timed
+        if args.memory_runs:
+            for name, figures in traced_benchmark(args).items():
+                if name in results:
+                    results[name]["peak_memory"] = figures["peak_memory"]
+        summary = summarize(results)
+        tracemalloc.start()
+        footprint = session_footprint(args) if args.sessions else None
+        tracemalloc.stop()
+        search = search_latency(args, os.path.join(workdir, "search.db")) if args.search_posts else None
+        audio = audio_throughput(args) if args.audio_requests else None
+
+    print(f"{'interaction':<16} {'p50 ms':>9} {'p95 ms':>9} {'reruns':>7} {'peak MiB':>9}")
+    for name, figures in summary.items():
+        peak = "-" if figures["peak_memory_mib"] is None else f"{figures['peak_memory_mib']:.1f}"
+        print(f"{name:<16} {figures['p50_ms']:>9.1f} {figures['p95_ms']:>9.1f} {figures['reruns']:>7.1f} {peak:>9}")
+    if throughput:
+        single, combined = throughput
+        print(
+            f"throughput: {single:.2f} interactions/s with 1 worker, {combined:.2f} with {args.workers} "
+            f"({combined / single:.2f}x, {combined / single / args.workers:.0%} of linear)"
+        )
+    if footprint:
+        print(
+            f"{footprint['sessions']} sessions: state mean {footprint['mean_kib']:.1f} KiB, max {footprint['max_kib']:.1f} KiB; "
+            f"{footprint['peak_memory_mib']:.1f} MiB peak traced memory, opened in {footprint['seconds']:.1f} s"
+        )
+    if logins:
+        print(
+            f"{logins['logins']} logins, {args.login_concurrency} at once: {logins['per_second']:.1f} logins/s, "
+            f"login click p50 {logins['p50_ms']:.0f} ms, p95 {logins['p95_ms']:.0f} ms"
+        )
+    if search:
+        print(f"search over {search['posts']} posts (full-text index built in {search['index_seconds']:.1f} s):")
+        for query, figures in search["queries"].items():
+            print(f"  {query!r:<18} p50 {figures['p50_ms']:7.1f} ms, p95 {figures['p95_ms']:7.1f} ms")
+    if audio:
+        (single, unbatched), (size, batched) = audio.items()
+        print(
+            f"audio: {unbatched:.1f} uploads/s in batches of {single}, {batched:.1f} in batches of {size} "
+            f"({batched / unbatched:.1f}x), fake model, {args.audio_requests} uploads at once"
+        )
+    if startup:
+        print(
+            f"cold start to the Home page, median of {args.cold_starts} fresh processes: lazy imports {startup['lazy_ms']:.0f} ms, "
+            f"eager {startup['eager_ms']:.0f} ms (+{startup['eager_ms'] - startup['lazy_ms']:.0f} ms)"
+        )
+        print(f"  eager preloaded {', '.join(startup['preloaded']) or 'nothing'}; not installed: {', '.join(startup['missing']) or 'none'}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = [
+            f"{name}: p95 {summary[name]['p95_ms']:.1f} ms vs {figures['p95_ms']:.1f} ms"
+            for name, figures in baseline.items()
+            if name in summary and summary[name]["p95_ms"] > figures["p95_ms"] * (1 + args.tolerance)
+        ]
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
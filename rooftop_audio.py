@@ -0,0 +1,374 @@
+# Audio question answering for Rooftop+Aydio.py: Qwen2-Audio loading, streaming decode with voice activity
+# trimming, micro-batched inference and a byte-bounded cache of decoded uploads and answers. Nothing here draws UI.
+import os
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+import streamlit as st
+
+from rooftop_core import (
+    FAKE_LLM_LATENCY, FAKE_LLM_TOKEN_RATE, FAKE_LLM_TOKENS, LLM_BACKEND, FakeModel, get_metrics, heavy_import,
+)
+
+AUDIO_MODEL = "Qwen/Qwen2-Audio-7B"
+AUDIO_DEVICE = os.environ.get("ROOFTOP_AUDIO_DEVICE", "cpu")  # "cpu", "cuda" or "auto"
+AUDIO_QUANTIZE = os.environ.get("ROOFTOP_AUDIO_QUANTIZE", "0") == "1"  # Dynamic int8 weights for CPU inference
+AUDIO_PROMPT = "<|audio_bos|><|AUDIO|><|audio_eos|>Answer the gardening question asked in this audio:"
+AUDIO_SAMPLE_RATE = 16000  # Rate the audio model expects
+AUDIO_CACHE_BYTES = 256 * 2**20  # Memory for decoded waveforms and answers of recent uploads
+AUDIO_CACHE_DIR = os.environ.get("ROOFTOP_AUDIO_CACHE_DIR")  # e.g. "audio_cache" to spill evicted entries to disk
+AUDIO_CACHE_DISK_BYTES = int(os.environ.get("ROOFTOP_AUDIO_CACHE_DISK_BYTES", "2147483648"))  # 2 GiB bound on AUDIO_CACHE_DIR
+AUDIO_BATCH_SIZE = 4  # Uploads generated together in one padded batch
+AUDIO_BATCH_WINDOW = 0.05  # Seconds the first request of a batch waits for others to join
+AUDIO_MAX_SECONDS = 60  # Uploads are cut off after this much audio
+AUDIO_BLOCK_SECONDS = 1.0  # Decode and resample this much audio at a time
+AUDIO_FRAME_SECONDS = 0.02  # Voice activity is decided per 20 ms frame
+AUDIO_SILENCE_DB = -40.0  # Frames quieter than this (dB full scale) count as silence
+
+# Offline stand-in for the audio model under ROOFTOP_LLM_BACKEND=fake. Like a padded batch on the real model,
+# a batch costs one first-token latency and then one step per token for all of its uploads at once.
+class FakeAudioModel(FakeModel):
+    # Same interface as generate_audio_batch: emit(row, text) gets each upload's new text after every step
+    def generate_batch(self, audios, emit):
+        time.sleep(self.latency)
+        rows = [re.findall(r"\w+", f"{len(audio) / AUDIO_SAMPLE_RATE:.1f} seconds of audio") for audio in audios]
+        answers = [[] for _ in audios]
+        for i in range(self.tokens):
+            time.sleep(1 / self.token_rate)
+            for row, words in enumerate(rows):
+                answers[row].append((" " if i else "") + words[i % len(words)])
+                emit(row, answers[row][-1])
+        return ["".join(parts) for parts in answers]
+
+# Pick the audio model device, falling back to CPU when CUDA is not available
+def select_audio_device(requested_device):
+    if requested_device in ("cuda", "auto") and heavy_import("torch").cuda.is_available():
+        return "cuda"
+    return "cpu"
+
+# Load the Qwen2-Audio model and processor once per process, on the first audio request
+@st.cache_resource(show_spinner="Loading audio model... 🎧")
+def get_audio_model(model_name, requested_device, quantize):
+    if LLM_BACKEND == "fake":
+        fake_model = FakeAudioModel(FAKE_LLM_LATENCY, FAKE_LLM_TOKEN_RATE, FAKE_LLM_TOKENS)
+        return {"model": fake_model, "processor": None, "device": "fake", "quantized": False, "load_time": 0.0, "first_token_time": FAKE_LLM_LATENCY}
+    torch = heavy_import("torch")
+    transformers = heavy_import("transformers")
+    device = select_audio_device(requested_device)
+    start = time.perf_counter()
+    processor = transformers.AutoProcessor.from_pretrained(model_name)
+    processor.tokenizer.padding_side = "left"  # Batched generation needs prompts aligned on the right
+    model = transformers.Qwen2AudioForConditionalGeneration.from_pretrained(
+        model_name, torch_dtype=torch.float16 if device == "cuda" else torch.float32
+    )
+    model.to(device).eval()
+    quantized = quantize and device == "cpu"
+    if quantized:
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    load_time = time.perf_counter() - start
+
+    # Warm up on one second of silence and time the first generated token
+    start = time.perf_counter()
+    silence = np.zeros(AUDIO_SAMPLE_RATE, dtype=np.float32)
+    inputs = processor(text=AUDIO_PROMPT, audios=silence, sampling_rate=AUDIO_SAMPLE_RATE, return_tensors="pt").to(device)
+    with torch.inference_mode():
+        model.generate(**inputs, max_new_tokens=1)
+    first_token_time = time.perf_counter() - start
+    return {
+        "model": model,
+        "processor": processor,
+        "device": device,
+        "quantized": quantized,
+        "load_time": load_time,
+        "first_token_time": first_token_time,
+    }
+
+# Fast energy-based voice activity: True for each whole frame louder than AUDIO_SILENCE_DB
+def voiced_frames(samples, frame_length):
+    frames = len(samples) // frame_length
+    power = np.square(samples[: frames * frame_length].reshape(frames, frame_length)).mean(axis=1)
+    return 10 * np.log10(power + 1e-12) > AUDIO_SILENCE_DB
+
+# Decode an upload block by block, resampling each block to 16 kHz as it is read, dropping leading and
+# trailing silence and stopping at AUDIO_MAX_SECONDS, so memory stays bounded by the duration cap.
+# Returns the waveform and decode figures (time, decode buffer size, input and kept duration). The buffer size
+# is what this upload allocated (the capped output plus its largest input block), counted without a process-wide tracer.
+def load_audio_stream(audio_file):
+    sf = heavy_import("soundfile")
+    soxr = heavy_import("soxr")
+    start = time.perf_counter()
+
+    frame_length = int(AUDIO_SAMPLE_RATE * AUDIO_FRAME_SECONDS)
+    audio = np.empty(AUDIO_MAX_SECONDS * AUDIO_SAMPLE_RATE, dtype=np.float32)
+    state = {"filled": 0, "voiced_end": 0, "started": False, "input_samples": 0, "largest_input": 0}
+
+    def append(chunk):
+        voiced = voiced_frames(chunk, frame_length)
+        if not state["started"]:
+            if not voiced.any():
+                return
+            first = int(np.argmax(voiced))
+            chunk, voiced = chunk[first * frame_length:], voiced[first:]
+            state["started"] = True
+        chunk = chunk[: len(audio) - state["filled"]]
+        audio[state["filled"]: state["filled"] + len(chunk)] = chunk
+        if voiced.any():
+            last_voiced = len(voiced) - int(np.argmax(voiced[::-1]))
+            state["voiced_end"] = state["filled"] + min(last_voiced * frame_length, len(chunk))
+        state["filled"] += len(chunk)
+
+    try:
+        with sf.SoundFile(audio_file) as source:
+            resampler = soxr.ResampleStream(source.samplerate, AUDIO_SAMPLE_RATE, 1, dtype="float32")
+            max_input = AUDIO_MAX_SECONDS * source.samplerate
+            for block in source.blocks(blocksize=int(source.samplerate * AUDIO_BLOCK_SECONDS), dtype="float32", always_2d=True):
+                state["input_samples"] += len(block)
+                state["largest_input"] = max(state["largest_input"], block.nbytes)
+                append(resampler.resample_chunk(block.mean(axis=1), last=False))
+                if state["input_samples"] >= max_input or state["filled"] == len(audio):
+                    break
+            append(resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True))
+            input_seconds = state["input_samples"] / source.samplerate
+    except RuntimeError:
+        # Formats libsndfile cannot read fall back to librosa, still capped at AUDIO_MAX_SECONDS
+        audio_file.seek(0)
+        with get_metrics().span("audio_librosa_load"):
+            decoded, _ = heavy_import("librosa").load(audio_file, sr=AUDIO_SAMPLE_RATE, duration=AUDIO_MAX_SECONDS)
+        input_seconds = len(decoded) / AUDIO_SAMPLE_RATE
+        state["largest_input"] = decoded.nbytes
+        append(decoded)
+
+    waveform = audio[: state["voiced_end"]].copy()
+    return waveform, {
+        "decode_time": time.perf_counter() - start,
+        "buffer_memory": audio.nbytes + state["largest_input"],
+        "input_seconds": input_seconds,
+        "kept_seconds": len(waveform) / AUDIO_SAMPLE_RATE,
+    }
+
+# Streamer for a batched generate(): keeps each row's generated ids and passes the newly decoded text of every
+# row to emit(row, text) after each step. generate() first puts the prompts, which are skipped.
+class BatchStreamer:
+    def __init__(self, tokenizer, rows, emit):
+        self.tokenizer = tokenizer
+        self.emit = emit
+        self.ids = [[] for _ in range(rows)]
+        self.sent = [0] * rows  # Characters of each row's text already emitted
+        self.prompts_seen = False
+
+    def put(self, value):
+        if not self.prompts_seen:
+            self.prompts_seen = True
+            return
+        for row, token in enumerate(value.reshape(-1).tolist()):
+            self.ids[row].append(token)
+            text = self.tokenizer.decode(self.ids[row], skip_special_tokens=True, clean_up_tokenization_spaces=False)
+            if len(text) > self.sent[row] and not text.endswith("\ufffd"):  # Hold back incomplete characters
+                self.emit(row, text[self.sent[row]:])
+                self.sent[row] = len(text)
+
+    def end(self):
+        pass
+
+# Generate answers for a padded batch of waveforms with Qwen2-Audio, streaming each row's text to emit(row, text)
+def generate_audio_batch(audio_service, audios, emit):
+    processor = audio_service["processor"]
+    inputs = processor(
+        text=[AUDIO_PROMPT] * len(audios),
+        audios=audios,
+        sampling_rate=AUDIO_SAMPLE_RATE,
+        return_tensors="pt",
+        padding=True,
+    ).to(audio_service["device"])
+    streamer = BatchStreamer(processor.tokenizer, len(audios), emit)
+    with heavy_import("torch").inference_mode():
+        generate_ids = audio_service["model"].generate(**inputs, max_new_tokens=256, streamer=streamer)
+    generate_ids = generate_ids[:, inputs.input_ids.size(1):]
+    return processor.batch_decode(generate_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+
+# In-process micro-batching for the audio model. Requests that arrive within AUDIO_BATCH_WINDOW of each
+# other are generated together by generate_batch(audios, emit), up to AUDIO_BATCH_SIZE, whether or not
+# they stream: streaming waiters get their own text as the batch produces it, the others their whole answer.
+class AudioBatcher:
+    def __init__(self, generate_batch, max_batch, window):
+        self.generate_batch = generate_batch
+        self.metrics = get_metrics()  # Held here because batches run on the batcher's own thread
+        self.max_batch = max_batch
+        self.window = window
+        self.requests = queue.Queue()
+        self.stats = {"batches": 0, "requests": 0, "largest": 0}
+        threading.Thread(target=self._serve, daemon=True, name="audio-batcher").start()
+
+    # Queue one waveform and yield its answer: piece by piece when streaming, else in one piece once its batch is done
+    def submit(self, audio, stream):
+        pieces = queue.Queue() if stream else None
+        future = Future()
+        self.requests.put((audio, pieces, future))
+        if pieces is None:
+            yield future.result()
+            return
+        sent = 0
+        while (piece := pieces.get()) is not None:
+            sent += len(piece)
+            yield piece
+        answer = future.result()
+        if answer[sent:]:  # Text the streamer held back at the very end
+            yield answer[sent:]
+
+    def _serve(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.requests.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            self._generate(batch)
+
+    def _generate(self, batch):
+        def emit(row, text):
+            pieces = batch[row][1]
+            if pieces is not None:
+                pieces.put(text)
+
+        try:
+            with self.metrics.span("audio_generate", batch=len(batch)):
+                answers = self.generate_batch([audio for audio, _, _ in batch], emit)
+            for (_, _, future), answer in zip(batch, answers):
+                future.set_result(answer)
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+        finally:
+            for _, pieces, _ in batch:
+                if pieces is not None:
+                    pieces.put(None)
+        self.stats["batches"] += 1
+        self.stats["requests"] += len(batch)
+        self.stats["largest"] = max(self.stats["largest"], len(batch))
+
+# One batching worker per process in front of the shared audio model
+@st.cache_resource(show_spinner=False)
+def get_audio_batcher(model_name, requested_device, quantize):
+    audio_service = get_audio_model(model_name, requested_device, quantize)
+    if LLM_BACKEND == "fake":
+        generate_batch = audio_service["model"].generate_batch
+    else:
+        generate_batch = lambda audios, emit: generate_audio_batch(audio_service, audios, emit)
+    return get_metrics().watch("audio_batcher", AudioBatcher(generate_batch, AUDIO_BATCH_SIZE, AUDIO_BATCH_WINDOW))
+
+# LRU cache bounded by total bytes for per-upload results keyed by content hash.
+# Entries evicted from memory are spilled to spill_dir when set and read back on a later hit. The spill directory
+# is an LRU too: a file is deleted when its entry moves back into memory, and the oldest files go past max_disk_bytes.
+class ByteLRUCache:
+    def __init__(self, max_bytes, spill_dir=None, max_disk_bytes=0):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.spilled = OrderedDict()  # key -> (path, bytes on disk), least recently spilled first
+        self.disk_size = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "disk_evictions": 0}
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            self._index_spilled()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return self.entries[key]
+            spilled = self.spilled.pop(key, None)
+            if spilled:
+                self.disk_size -= spilled[1]
+        value = self._read_spilled(spilled[0]) if spilled else None
+        with self.lock:
+            self.stats["disk_hits" if value is not None else "misses"] += 1
+        if value is not None:
+            self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.entries:
+                self.size -= self._size_of(self.entries.pop(key))
+            if key in self.spilled:
+                self._remove_spilled(key)
+            self.entries[key] = value
+            self.size += self._size_of(value)
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                evicted_key, evicted = self.entries.popitem(last=False)
+                self.size -= self._size_of(evicted)
+                self.stats["evictions"] += 1
+                self._spill(evicted_key, evicted)
+
+    def _size_of(self, value):
+        return value.nbytes if isinstance(value, np.ndarray) else len(value.encode())
+
+    # Called with the lock held
+    def _spill(self, key, value):
+        if not self.spill_dir:
+            return
+        if isinstance(value, np.ndarray):
+            path = os.path.join(self.spill_dir, f"{key}.npy")
+            np.save(path, value)
+        else:
+            path = os.path.join(self.spill_dir, f"{key}.txt")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(value)
+        self.spilled[key] = (path, os.path.getsize(path))
+        self.disk_size += self.spilled[key][1]
+        while self.disk_size > self.max_disk_bytes and self.spilled:
+            self._remove_spilled(next(iter(self.spilled)))
+            self.stats["disk_evictions"] += 1
+
+    # Called with the lock held
+    def _remove_spilled(self, key):
+        path, size = self.spilled.pop(key)
+        self.disk_size -= size
+        self._delete(path)
+
+    # Files spilled by an earlier process count against max_disk_bytes too, oldest first
+    def _index_spilled(self):
+        files = []
+        for name in os.listdir(self.spill_dir):
+            key, extension = os.path.splitext(name)
+            path = os.path.join(self.spill_dir, name)
+            if extension in (".npy", ".txt") and os.path.isfile(path):
+                files.append((os.path.getmtime(path), key, path, os.path.getsize(path)))
+        for _, key, path, size in sorted(files):
+            self.spilled[key] = (path, size)
+            self.disk_size += size
+        while self.disk_size > self.max_disk_bytes and self.spilled:
+            self._remove_spilled(next(iter(self.spilled)))
+
+    # The file is deleted whether or not it could be read: its entry is now in memory or gone
+    def _read_spilled(self, path):
+        try:
+            if path.endswith(".npy"):
+                return np.load(path)
+            with open(path, encoding="utf-8") as f:
+                return f.read()
+        except OSError:
+            return None
+        finally:
+            self._delete(path)
+
+    def _delete(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+@st.cache_resource(show_spinner=False)
+def get_audio_cache(max_bytes, spill_dir, max_disk_bytes):
+    return get_metrics().watch("audio_cache", ByteLRUCache(max_bytes, spill_dir, max_disk_bytes))
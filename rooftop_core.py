@@ -0,0 +1,1800 @@
+# Shared infrastructure for Rooftop.py and Rooftop+Aydio.py: settings, the SQLite stores, the LLM backends,
+# the generation dispatcher and caches, the semantic index and metrics. Nothing here draws UI. Being a module,
+# it is imported once per process, so its classes and shared objects stay the same across script reruns.
+import asyncio
+import hashlib
+import heapq
+import hmac
+import importlib
+import json
+import logging
+import os
+import queue
+import random
+import re
+import secrets
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing, contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import unquote
+
+import numpy as np
+import streamlit as st
+
+LOCAL_MODEL_PATH = os.environ.get("ROOFTOP_LOCAL_MODEL")  # Quantized GGUF file for the local llama.cpp backend
+LOCAL_MODEL_THREADS = int(os.environ.get("ROOFTOP_LOCAL_MODEL_THREADS", "0"))  # CPU threads; 0 lets llama.cpp choose
+LOCAL_MODEL_CONTEXT = 2048  # Tokens of context for the local model
+LOCAL_MAX_TOKENS = 512  # Longest answer the local model generates
+LLM_BACKEND = os.environ.get("ROOFTOP_LLM_BACKEND", "gemini")  # "gemini", "local" (llama.cpp) or "fake" to run offline for benchmarks
+LLM_FALLBACK = os.environ.get("ROOFTOP_LLM_FALLBACK", "local" if LOCAL_MODEL_PATH else "none")  # Used when LLM_BACKEND is slow or down
+LLM_LATENCY_BUDGET = float(os.environ.get("ROOFTOP_LLM_LATENCY_BUDGET", "5"))  # Seconds to first token before routing to the fallback
+LLM_FIRST_TOKEN_TIMEOUT = float(os.environ.get("ROOFTOP_LLM_FIRST_TOKEN_TIMEOUT", "10"))  # Seconds to wait before abandoning LLM_BACKEND
+LLM_PROBE_SECONDS = 60  # How often a backend over its latency budget is tried again
+FAKE_LLM_LATENCY = float(os.environ.get("ROOFTOP_FAKE_LATENCY", "0.2"))  # Seconds before the fake model's first token
+FAKE_LLM_TOKEN_RATE = float(os.environ.get("ROOFTOP_FAKE_TOKEN_RATE", "50"))  # Fake tokens streamed per second
+FAKE_LLM_TOKENS = 64  # Words in each fake answer
+RESPONSE_CACHE_SIZE = 512  # Answers kept in memory
+RESPONSE_CACHE_TTL = 24 * 3600  # Seconds before a cached answer is regenerated
+WORKERS = int(os.environ.get("ROOFTOP_WORKERS", "1"))  # Streamlit processes sharing the databases below, e.g. behind a load balancer
+RESPONSE_CACHE_DB = os.environ.get("ROOFTOP_CACHE_DB", "response_cache.db" if WORKERS > 1 else None)  # Set to keep answers across restarts; shared by all workers
+PROMPT_ANSWER_DB = os.environ.get("ROOFTOP_ANSWER_DB", "prompt_answers.db")  # Pre-warmed Prompts page answers
+PREWARM_WORKERS = 4  # Concurrent generation calls while pre-warming
+GENERATION_CONCURRENCY = int(os.environ.get("ROOFTOP_GENERATION_CONCURRENCY", "4"))  # Upstream calls in flight per process
+GENERATION_RATE = float(os.environ.get("ROOFTOP_GENERATION_RATE", "1.0"))  # Upstream calls started per second, across all workers
+GENERATION_BURST = 5  # Calls that may start at once after an idle spell, across all workers
+GENERATION_RETRIES = 3  # Retries on rate-limit errors
+GENERATION_BACKOFF_BASE = 1.0  # Seconds; doubles on each retry, with full jitter
+GENERATION_BACKOFF_MAX = 20.0
+GENERATION_DEADLINE = 90  # Seconds a request may spend queued, retrying and waiting for its first token
+REMINDER_DB = os.environ.get("ROOFTOP_REMINDER_DB", "reminders.db")  # Reminder timers, kept across logins and restarts
+REMINDER_REFRESH_SECONDS = 30  # How often the reminders panel refreshes on its own
+DEFAULT_REMINDERS = [("My rooftop garden", "water", 24 * 3600), ("My rooftop garden", "fertilizer", 48 * 3600)]
+REMINDER_LABELS = {"water": "💧 Water Reminder", "fertilizer": "🌱 Fertilizer Reminder"}
+REMINDER_PANEL_SIZE = 5  # Reminders drawn in the panel, soonest due first
+FORUM_DB = os.environ.get("ROOFTOP_FORUM_DB", "forum.db")  # Shared by all sessions; put it on a shared volume for several workers
+FORUM_PAGE_SIZE = 20  # Posts rendered per forum page
+FORUM_REPLY_LIMIT = 50  # Replies loaded when a thread is opened
+FORUM_SEARCH_LIMIT = 20  # Search results shown per query
+FORUM_SEARCH_RANKED = 1000  # Newest matches ranked per search, bounding its cost however common the terms are
+FORUM_SEARCH_MIN_PREFIX = 2  # Shorter terms match whole words only, not every word starting with them
+FORUM_CACHE_ENTRIES = 512  # Forum pages, posts and reply lists shared by all sessions between writes
+SEMANTIC_INDEX_DIR = os.environ.get("ROOFTOP_SEMANTIC_DIR", "semantic_index")  # Memory-mapped embedding matrix and its entries
+EMBEDDING_MODEL = os.environ.get("ROOFTOP_EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")  # "hash" needs no model
+SEMANTIC_REUSE_THRESHOLD = 0.92  # Cosine similarity above which a stored answer is returned as is
+SEMANTIC_CONTEXT_THRESHOLD = 0.6  # Cosine similarity above which a match is passed to the model as context
+SEMANTIC_TOP_K = 3  # Matches considered per question
+SEMANTIC_SNIPPET_CHARS = 500  # Characters kept from each context snippet
+CHAT_DB = os.environ.get("ROOFTOP_CHAT_DB", "chats.db")  # Conversation history per user
+CHAT_HISTORY_TOKENS = 1500  # Budget for the summary and recent turns sent with each follow-up
+CHAT_SUMMARY_WORDS = 150  # Length cap for the running summary of older turns
+CHAT_MAX_TURNS = 50  # Newest turns considered when filling the history budget
+CHAT_THREAD_IDLE = 30 * 60  # Seconds after the last turn when the next question starts a new conversation
+CHAT_SESSION_TTL = 24 * 3600  # Seconds the turns of a session that is not logged in are kept
+USER_DB = os.environ.get("ROOFTOP_USER_DB", "users.db")  # Accounts with salted scrypt password hashes, shared by all workers
+SEED_USERS = ["sanketh", "nikhil", "karthik", "shiva"]  # Created with SEED_PASSWORD when the user store is empty
+SEED_PASSWORD = os.environ.get("ROOFTOP_SEED_PASSWORD", "rooftop")
+PASSWORD_HASH = {"n": 2**14, "r": 8, "p": 1}  # scrypt cost: 16 MiB and roughly 50-100 ms per check
+PASSWORD_WORKERS = 4  # Password checks running at once per process, which bounds their memory
+SESSION_SECRET = os.environ.get("ROOFTOP_SESSION_SECRET")  # Signs login tokens; generated and kept in USER_DB when unset
+SESSION_TTL = 7 * 24 * 3600  # Seconds a login token stays valid
+SESSION_COOKIE = "rooftop_session"  # Cookie holding the login token, which keeps it out of URLs, history and Referer headers
+LOGIN_ATTEMPTS = 5  # Failed logins allowed per user and per client address within LOGIN_WINDOW
+LOGIN_WINDOW = 300  # Seconds
+TRUSTED_PROXIES = set(filter(None, os.environ.get("ROOFTOP_TRUSTED_PROXIES", "").split(",")))  # Proxy addresses whose X-Forwarded-For is believed
+ADMIN_USERS = set(os.environ.get("ROOFTOP_ADMINS", "sanketh").split(","))  # Users who see the Metrics page
+METRICS_WINDOW = 1024  # Recent samples kept per span for percentiles
+METRICS_PORT = int(os.environ.get("ROOFTOP_METRICS_PORT", "0"))  # Serve the Prometheus export on this port (the next free one per worker); 0 disables it
+METRICS_REFRESH_SECONDS = 5  # How often the Metrics page refreshes on its own
+SESSION_REPORT_TTL = 3600  # Seconds a session counts in the memory report after its last run
+
+# Immutable records shared by every session. Named tuples carry no per-instance __dict__ (their __slots__
+# is empty), so each one costs a tuple of pointers to strings that are themselves shared.
+PromptRecord = namedtuple("PromptRecord", "id category text")
+PostRecord = namedtuple("PostRecord", "id user content timestamp reply_count")
+ReplyRecord = namedtuple("ReplyRecord", "user content timestamp")
+
+# Process-wide startup figures: time spent importing each heavy module and the first page run of this process
+@st.cache_resource(show_spinner=False)
+def get_startup_report():
+    return {"imports": {}, "first_run": None}
+
+# Import a heavy module on first use, so pages that never need it never pay for it
+def heavy_import(module_name):
+    started = time.perf_counter()
+    module = importlib.import_module(module_name)
+    get_startup_report()["imports"].setdefault(module_name, time.perf_counter() - started)
+    return module
+
+logger = logging.getLogger("rooftop")
+
+# Process-wide tracing for the hot paths: recent span timings, error counters and the stats of the shared
+# caches and queues, exported in Prometheus text format and shown on the admin Metrics page
+class Metrics:
+    def __init__(self, window):
+        self.window = window
+        self.lock = threading.Lock()
+        self.samples = {}  # (name, labels) -> the last `window` durations in seconds
+        self.totals = {}  # (name, labels) -> [count, sum] since the process started
+        self.counters = {}  # (name, labels) -> count
+        self.sources = {}  # name -> shared object whose numeric .stats are exported as gauges
+        self.port = None  # Port the Prometheus export is served on, if any
+
+    # Time a block of code; exceptions escaping it are counted as errors of the span
+    @contextmanager
+    def span(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.count("errors", span=name)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.samples.setdefault(key, deque(maxlen=self.window)).append(seconds)
+            totals = self.totals.setdefault(key, [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+
+    def count(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    def watch(self, name, source):
+        self.sources[name] = source
+        return source
+
+    def snapshot(self):
+        with self.lock:
+            samples = {key: np.array(values) for key, values in self.samples.items()}
+            totals = {key: tuple(value) for key, value in self.totals.items()}
+            counters = dict(self.counters)
+        return samples, totals, counters
+
+    # Recent percentiles per span, slowest p95 first
+    def percentiles(self):
+        samples, totals, _ = self.snapshot()
+        rows = []
+        for (name, labels), values in samples.items():
+            p50, p95, p99 = np.percentile(values, [50, 95, 99]) * 1000
+            rows.append({
+                "span": name + prometheus_labels(labels),
+                "count": totals[(name, labels)][0],
+                "p50 ms": round(p50, 1),
+                "p95 ms": round(p95, 1),
+                "p99 ms": round(p99, 1),
+                "max ms": round(values.max() * 1000, 1),
+            })
+        return sorted(rows, key=lambda row: -row["p95 ms"])
+
+    def prometheus(self):
+        samples, totals, counters = self.snapshot()
+        lines = []
+        previous = None
+        for (name, labels), values in sorted(samples.items()):
+            if name != previous:
+                lines.append(f"# TYPE rooftop_{name}_seconds summary")
+                previous = name
+            for quantile in (0.5, 0.95, 0.99):
+                lines.append(f"rooftop_{name}_seconds{prometheus_labels(labels + (('quantile', quantile),))} {np.quantile(values, quantile):.6f}")
+            count, total = totals[(name, labels)]
+            lines.append(f"rooftop_{name}_seconds_sum{prometheus_labels(labels)} {total:.6f}")
+            lines.append(f"rooftop_{name}_seconds_count{prometheus_labels(labels)} {count}")
+        previous = None
+        for (name, labels), value in sorted(counters.items()):
+            if name != previous:
+                lines.append(f"# TYPE rooftop_{name}_total counter")
+                previous = name
+            lines.append(f"rooftop_{name}_total{prometheus_labels(labels)} {value}")
+        for source_name, source in sorted(self.sources.items()):
+            for stat, value in sorted(source.stats.items()):
+                if isinstance(value, (int, float)):
+                    lines.append(f"# TYPE rooftop_{source_name}_{stat} gauge")
+                    lines.append(f"rooftop_{source_name}_{stat} {value}")
+        return "\n".join(lines) + "\n"
+
+def prometheus_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+# Serve the Prometheus export on its own port, since Streamlit cannot add HTTP routes.
+# Each worker takes the first free port from `port` on, so several workers can share one config.
+def serve_metrics(metrics, port):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    for candidate in range(port, port + WORKERS):
+        try:
+            server = ThreadingHTTPServer(("", candidate), MetricsHandler)
+        except OSError:
+            continue
+        threading.Thread(target=server.serve_forever, daemon=True, name="metrics-server").start()
+        return candidate
+    logger.warning("No free metrics port in %d-%d; not serving metrics from this worker", port, port + WORKERS - 1)
+    return None
+
+@st.cache_resource(show_spinner=False)
+def get_metrics():
+    metrics = Metrics(METRICS_WINDOW)
+    if METRICS_PORT:
+        metrics.port = serve_metrics(metrics, METRICS_PORT)
+    return metrics
+
+# Offline stand-in for the LLM, selected with ROOFTOP_LLM_BACKEND=fake for benchmarks and demos without network.
+# It waits `latency` seconds before the first token, then emits `tokens` words of the prompt at `token_rate` per second.
+class FakeModel:
+    def __init__(self, latency, token_rate, tokens):
+        self.latency = latency
+        self.token_rate = token_rate
+        self.tokens = tokens
+
+    def generate_content(self, prompt, stream=False):
+        chunks = self._chunks(prompt)
+        if stream:
+            return chunks
+        return SimpleNamespace(text="".join(chunk.text for chunk in chunks))
+
+    def _chunks(self, prompt):
+        time.sleep(self.latency)
+        words = re.findall(r"\w+", prompt) or ["garden"]
+        for i in range(self.tokens):
+            time.sleep(1 / self.token_rate)
+            yield SimpleNamespace(text=(" " if i else "") + words[i % len(words)])
+
+# Local CPU model through llama.cpp, loaded from a quantized GGUF file, so the chatbot keeps answering offline.
+# Exposes generate_content like the Gemini model; one generation runs at a time since a llama.cpp context is not thread safe.
+class LlamaCppModel:
+    def __init__(self, model_path, threads, context, max_tokens):
+        llama_cpp = heavy_import("llama_cpp")
+        self.llm = llama_cpp.Llama(model_path=model_path, n_ctx=context, n_threads=threads or None, verbose=False)
+        self.max_tokens = max_tokens
+        self.lock = threading.Lock()
+
+    def generate_content(self, prompt, stream=False):
+        chunks = self._chunks(prompt)
+        if stream:
+            return chunks
+        return SimpleNamespace(text="".join(chunk.text for chunk in chunks))
+
+    def _chunks(self, prompt):
+        with self.lock:
+            messages = [{"role": "user", "content": prompt}]
+            for part in self.llm.create_chat_completion(messages=messages, max_tokens=self.max_tokens, stream=True):
+                text = part["choices"][0]["delta"].get("content")
+                if text:
+                    yield SimpleNamespace(text=text)
+
+def build_backend(name, model_name, api_key, generation_config):
+    if name == "fake":
+        return FakeModel(FAKE_LLM_LATENCY, FAKE_LLM_TOKEN_RATE, FAKE_LLM_TOKENS)
+    if name == "local":
+        if not LOCAL_MODEL_PATH:
+            raise RuntimeError("Set ROOFTOP_LOCAL_MODEL to a GGUF model file to use the local backend")
+        return LlamaCppModel(LOCAL_MODEL_PATH, LOCAL_MODEL_THREADS, LOCAL_MODEL_CONTEXT, LOCAL_MAX_TOKENS)
+    genai = heavy_import("google.generativeai")
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel(model_name, generation_config=generation_config or None)
+
+# Routes each question between a primary backend and a fallback, both exposing generate_content.
+# The primary is used while its smoothed time to first token stays within the latency budget; once it
+# goes over, questions go to the fallback and the primary is only probed every LLM_PROBE_SECONDS.
+# A primary that fails or gives no first token within `timeout` is abandoned for the fallback.
+class BackendRouter:
+    def __init__(self, primary_name, primary, fallback_name, build_fallback, budget, timeout):
+        self.primary_name = primary_name
+        self.primary = primary
+        self.fallback_name = fallback_name
+        self.build_fallback = build_fallback  # The fallback is only loaded the first time it is needed
+        self.fallback = None
+        self.budget = budget
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.first_token = {primary_name: None, fallback_name: None}  # Smoothed seconds to first token
+        self.probe_at = 0.0
+        self.metrics = get_metrics()  # Held here because generation runs on dispatcher threads
+        self.stats = {"primary": 0, "fallback": 0, "over_budget": 0, "timeouts": 0, "errors": 0}
+
+    def generate_content(self, prompt, stream=False):
+        chunks = self._route(prompt)
+        if stream:
+            return chunks
+        return SimpleNamespace(text="".join(chunk.text for chunk in chunks))
+
+    def describe(self):
+        latencies = " · ".join(
+            f"{name} {'not used yet' if seconds is None else f'{seconds:.2f} s'}" for name, seconds in self.first_token.items()
+        )
+        return (
+            f"Time to first token: {latencies} (budget {self.budget:.1f} s) · "
+            f"{self.stats['primary']} answered by {self.primary_name}, {self.stats['fallback']} by {self.fallback_name}"
+        )
+
+    def _route(self, prompt):
+        latency = self.first_token[self.primary_name]
+        if latency is not None and latency > self.budget and time.monotonic() < self.probe_at:
+            self.stats["over_budget"] += 1
+        else:
+            chunks = queue.Queue()
+            abandoned = threading.Event()
+            threading.Thread(target=self._produce, args=(prompt, chunks, abandoned), daemon=True, name="llm-primary").start()
+            start = time.perf_counter()
+            try:
+                first = chunks.get(timeout=self.timeout)
+            except queue.Empty:
+                first = TimeoutError(f"No first token from {self.primary_name} within {self.timeout} s")
+            if not isinstance(first, Exception):
+                self._record(self.primary_name, time.perf_counter() - start)
+                self.stats["primary"] += 1
+                try:
+                    while first is not None:
+                        yield first
+                        first = chunks.get()
+                        if isinstance(first, Exception):
+                            raise first
+                finally:
+                    abandoned.set()
+                return
+            abandoned.set()  # The primary stops at its next chunk instead of generating an answer nobody reads
+            self.stats["timeouts" if isinstance(first, TimeoutError) else "errors"] += 1
+            self.metrics.count("llm_fallbacks", backend=self.primary_name, reason=type(first).__name__)
+            self._record(self.primary_name, max(self.timeout, time.perf_counter() - start))
+            logger.warning("Falling back to %s: %s", self.fallback_name, first)
+
+        self.stats["fallback"] += 1
+        start = time.perf_counter()
+        for i, chunk in enumerate(self._fallback().generate_content(prompt, stream=True)):
+            if i == 0:
+                self._record(self.fallback_name, time.perf_counter() - start)
+            yield SimpleNamespace(text=chunk.text, fallback=True)  # Tagged so callers can keep it out of caches
+
+    # Stream the primary's chunks into a queue, ending with None or the exception that stopped it
+    def _produce(self, prompt, chunks, abandoned):
+        try:
+            for chunk in self.primary.generate_content(prompt, stream=True):
+                if abandoned.is_set():
+                    break
+                chunks.put(chunk)
+            chunks.put(None)
+        except Exception as e:
+            chunks.put(e)
+
+    def _fallback(self):
+        with self.lock:
+            if self.fallback is None:
+                self.fallback = self.build_fallback()
+            return self.fallback
+
+    def _record(self, name, seconds):
+        previous = self.first_token[name]
+        self.first_token[name] = seconds if previous is None else 0.7 * previous + 0.3 * seconds
+        if name == self.primary_name and self.first_token[name] > self.budget:
+            self.probe_at = time.monotonic() + LLM_PROBE_SECONDS
+        self.metrics.observe("llm_first_token", seconds, backend=name)
+
+# Build the chat model once per process and share it across reruns and sessions: the LLM_BACKEND model,
+# behind a BackendRouter when LLM_FALLBACK names a second backend.
+# get_chat_model.clear() invalidates the entries. The API key does not separate them: genai.configure sets it for
+# the whole process, so every Gemini model uses the most recently configured key.
+@st.cache_resource(show_spinner=False)
+def get_chat_model(model_name, api_key, generation_config):
+    start = time.perf_counter()
+    model = build_backend(LLM_BACKEND, model_name, api_key, generation_config)
+    if LLM_FALLBACK not in ("none", LLM_BACKEND):
+        build_fallback = lambda: build_backend(LLM_FALLBACK, model_name, api_key, generation_config)
+        router = BackendRouter(LLM_BACKEND, model, LLM_FALLBACK, build_fallback, LLM_LATENCY_BUDGET, LLM_FIRST_TOKEN_TIMEOUT)
+        model = get_metrics().watch("llm_router", router)
+    return {"model": model, "build_time": time.perf_counter() - start, "built_at": time.time()}
+
+# Open a SQLite connection in WAL mode so readers never block the single writer, across threads and processes
+def connect_db(db_path):
+    db = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+# Changes whenever another connection, in this or another worker process, commits to the database.
+# In-process caches compare it before use to drop what other workers have made stale.
+def data_version(db):
+    return db.execute("PRAGMA data_version").fetchone()[0]
+
+# Fold whitespace, case and punctuation so pasted variants of a question share one cache entry
+def normalize_question(text):
+    text = re.sub(r"[^\w\s]", " ", text.lower())
+    return " ".join(text.split())
+
+# Response cache key of a question; answers from different backends are cached apart
+def answer_key(question):
+    return f"{LLM_BACKEND}|{normalize_question(question)}"
+
+# Bounded LRU cache of chatbot answers with a TTL and optional SQLite persistence
+class ResponseCache:
+    def __init__(self, max_entries, ttl, db_path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (answer, created)
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "hit_time": 0.0, "miss_time": 0.0}
+        self.db = None
+        if db_path:
+            self.db = connect_db(db_path)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, answer TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self.db.commit()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None and self.db is not None:
+                entry = self.db.execute("SELECT answer, created FROM responses WHERE key = ?", (key,)).fetchone()
+                if entry is not None:
+                    self._remember(key, tuple(entry))
+            if entry is None:
+                return None
+            if time.time() - entry[1] > self.ttl:
+                self.entries.pop(key, None)
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, answer):
+        created = time.time()
+        with self.lock:
+            self._remember(key, (answer, created))
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, answer, created))
+                self.db.execute("DELETE FROM responses WHERE created < ?", (created - self.ttl,))
+                self.db.commit()
+
+    def record(self, hit, elapsed):
+        with self.lock:
+            self.stats["hits" if hit else "misses"] += 1
+            self.stats["hit_time" if hit else "miss_time"] += elapsed
+
+    def _remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+# Share one response cache across all sessions in the process
+@st.cache_resource(show_spinner=False)
+def get_response_cache(max_entries, ttl, db_path):
+    return get_metrics().watch("response_cache", ResponseCache(max_entries, ttl, db_path))
+
+# Rate-limit errors from the provider (HTTP 429 / ResourceExhausted) are worth retrying
+def is_rate_limited(error):
+    return getattr(error, "code", None) == 429 or type(error).__name__ in ("ResourceExhausted", "TooManyRequests")
+
+# Shared asyncio dispatcher for upstream generation calls, running its own event loop on a daemon thread.
+# Caps concurrent calls, paces them with a token bucket, retries rate-limit errors with jittered
+# exponential backoff and gives up once a request's deadline passes.
+class GenerationDispatcher:
+    def __init__(self, concurrency, rate, burst, retries):
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.tokens = float(burst)
+        self.refilled_at = time.monotonic()
+        self.loop = asyncio.new_event_loop()
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="generation")
+        self.stats = {"waiting": 0, "running": 0, "completed": 0, "failed": 0, "retries": 0, "wait_time": 0.0, "max_wait": 0.0}
+        threading.Thread(target=self.loop.run_forever, daemon=True, name="generation-dispatcher").start()
+
+    # Run fn() through the dispatcher from a script thread, blocking until it returns
+    def submit(self, fn, deadline):
+        return asyncio.run_coroutine_threadsafe(self._run(fn, deadline), self.loop).result()
+
+    # Run a streaming call through the dispatcher, yielding its chunks on the calling thread as they arrive.
+    # The deadline only covers getting the first chunk, so long answers are never cut off part way; the
+    # concurrency slot stays held until the whole stream has been produced or its reader goes away.
+    def stream(self, open_stream, deadline):
+        chunks = queue.Queue()
+        done = object()
+        abandoned = threading.Event()
+
+        def produce():
+            started = False
+            try:
+                with closing(open_stream()) as stream:  # Closing the generator releases the backend (e.g. its lock)
+                    for chunk in stream:
+                        if abandoned.is_set():
+                            return
+                        started = True
+                        chunks.put(chunk)
+            except Exception as e:
+                if started:  # Never retry once part of the answer has been shown
+                    raise RuntimeError(f"Generation failed mid-stream: {e}") from e
+                raise
+
+        future = asyncio.run_coroutine_threadsafe(self._queue_and_call(produce, time.monotonic() + deadline), self.loop)
+        future.add_done_callback(lambda _: chunks.put(done))
+        try:
+            try:
+                chunk = chunks.get(timeout=deadline)
+            except queue.Empty:
+                future.cancel()
+                self.stats["failed"] += 1
+                raise TimeoutError(f"Generation did not start within {deadline} s") from None
+            while chunk is not done:
+                yield chunk
+                chunk = chunks.get()
+        finally:
+            abandoned.set()
+        future.result()
+
+    async def _run(self, fn, deadline):
+        try:
+            return await asyncio.wait_for(self._queue_and_call(fn, time.monotonic() + deadline), timeout=deadline)
+        except asyncio.TimeoutError:
+            self.stats["failed"] += 1
+            raise TimeoutError(f"Generation did not finish within {deadline} s") from None
+
+    async def _queue_and_call(self, fn, expires_at):
+        queued_at = time.monotonic()
+        self.stats["waiting"] += 1
+        admitted = False
+        try:
+            async with self.semaphore:
+                await self._take_token()
+                admitted = True
+                self._admit(queued_at)
+                try:
+                    return await self._call(fn, expires_at)
+                finally:
+                    self.stats["running"] -= 1
+        finally:
+            if not admitted:
+                self.stats["waiting"] -= 1
+
+    def _admit(self, queued_at):
+        waited = time.monotonic() - queued_at
+        self.stats["waiting"] -= 1
+        self.stats["running"] += 1
+        self.stats["wait_time"] += waited
+        self.stats["max_wait"] = max(self.stats["max_wait"], waited)
+
+    async def _call(self, fn, expires_at):
+        for attempt in range(self.retries + 1):
+            try:
+                result = await self.loop.run_in_executor(self.executor, fn)
+                self.stats["completed"] += 1
+                return result
+            except Exception as e:
+                backoff = random.uniform(0, min(GENERATION_BACKOFF_MAX, GENERATION_BACKOFF_BASE * 2**attempt))
+                if not is_rate_limited(e) or attempt == self.retries or time.monotonic() + backoff > expires_at:
+                    self.stats["failed"] += 1
+                    raise
+                self.stats["retries"] += 1
+                await asyncio.sleep(backoff)
+                await self._take_token()
+
+    # Token bucket: refill at `rate` tokens per second up to `burst`, waiting when it is empty
+    async def _take_token(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+            self.refilled_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+# The upstream rate limit is shared by every worker, so each process paces itself to its share
+@st.cache_resource(show_spinner=False)
+def get_dispatcher(concurrency, rate, burst, retries):
+    return get_metrics().watch("generation", GenerationDispatcher(concurrency, rate / WORKERS, max(1, burst // WORKERS), retries))
+
+# Single-flight for identical questions: the first asker generates, and concurrent askers of the same
+# normalized question follow that answer as it streams instead of starting their own upstream call
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}  # key -> in-flight answer shared with followers
+        self.stats = {"leaders": 0, "collapsed": 0}
+
+    # Returns the in-flight answer for key and whether the caller is its leader
+    def join(self, key):
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                self.stats["collapsed"] += 1
+                return flight, False
+            flight = {"chunks": [], "done": False, "error": None, "condition": threading.Condition()}
+            self.flights[key] = flight
+            self.stats["leaders"] += 1
+            return flight, True
+
+    def publish(self, flight, chunk):
+        with flight["condition"]:
+            flight["chunks"].append(chunk)
+            flight["condition"].notify_all()
+
+    def finish(self, key, flight, error=None):
+        with self.lock:
+            self.flights.pop(key, None)
+        with flight["condition"]:
+            flight["done"] = True
+            flight["error"] = error
+            flight["condition"].notify_all()
+
+    # Replay the leader's chunks as they are published, re-raising the leader's error if it failed
+    def follow(self, flight):
+        index = 0
+        while True:
+            with flight["condition"]:
+                while index == len(flight["chunks"]) and not flight["done"]:
+                    flight["condition"].wait()
+                chunks = flight["chunks"][index:]
+                index += len(chunks)
+                finished = flight["done"] and index == len(flight["chunks"])
+            yield from chunks
+            if finished:
+                if flight["error"] is not None:
+                    raise flight["error"]
+                return
+
+@st.cache_resource(show_spinner=False)
+def get_single_flight():
+    return get_metrics().watch("single_flight", SingleFlight())
+
+# Stream an answer from the response cache, or from the model on a miss and cache the full text.
+# Identical questions already being generated are shared rather than sent upstream again.
+# Sets stats["cached"] and stats["collapsed"] so callers can tell how the answer was served.
+def stream_answer(model, question, stats, cache=None, prompt=None):
+    cache = cache or get_response_cache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_DB)
+    key = answer_key(question)
+    start = time.perf_counter()
+    answer = cache.get(key)
+    stats["cached"] = answer is not None
+    stats["collapsed"] = False
+    if stats["cached"]:
+        yield answer
+    else:
+        single_flight = get_single_flight()
+        flight, leader = single_flight.join(key)
+        stats["collapsed"] = not leader
+        if not leader:
+            yield from single_flight.follow(flight)
+        else:
+            error = RuntimeError("The original request for this answer was abandoned")
+            try:
+                parts = []
+                dispatcher = get_dispatcher(GENERATION_CONCURRENCY, GENERATION_RATE, GENERATION_BURST, GENERATION_RETRIES)
+                served = {"fallback": False}
+
+                def open_stream():
+                    for chunk in model.generate_content(prompt or question, stream=True):
+                        served["fallback"] = getattr(chunk, "fallback", False)
+                        yield chunk.text
+
+                with get_metrics().span("llm_generate"):
+                    for text in dispatcher.stream(open_stream, GENERATION_DEADLINE):
+                        parts.append(text)
+                        single_flight.publish(flight, text)
+                        yield text
+                # Stand-in answers from the fallback backend are not kept for later questions
+                if not served["fallback"]:
+                    cache.put(key, "".join(parts))
+                    index_entries([("answer", key, question, "".join(parts))])
+                error = None
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                single_flight.finish(key, flight, error)
+    cache.record(stats["cached"], time.perf_counter() - start)
+
+# Pass text chunks through, recording the full text, time to first token and tokens per second in stats
+def timed_chunks(chunks, stats):
+    start = time.perf_counter()
+    parts = []
+    stats.update(first_token=None, tokens=0)
+    for text in chunks:
+        if stats["first_token"] is None:
+            stats["first_token"] = time.perf_counter() - start
+        parts.append(text)
+        stats["tokens"] += len(text.split())  # Token count approximated by words
+        yield text
+    stats["text"] = "".join(parts)
+    stats["elapsed"] = time.perf_counter() - start
+    stats["tokens_per_sec"] = stats["tokens"] / stats["elapsed"] if stats["elapsed"] > 0 else 0.0
+
+# Answer a question in one piece, from the response cache when possible
+def answer_question(model, question, cache=None):
+    stats = {}
+    for _ in timed_chunks(stream_answer(model, question, stats, cache), stats):
+        pass
+    return stats
+
+# Roughly four characters per token, enough for budgeting without a round trip to count them
+def estimate_tokens(text):
+    return max(1, len(text) // 4) if text else 0
+
+# Multi-turn chat history per user: one row per question and answer with the tokens each turn sent and
+# received upstream, plus a running summary covering every turn up to `through_id`
+class ChatStore:
+    def __init__(self, db_path):
+        self.lock = threading.Lock()
+        self.summarizing = set()  # Users whose summary is being updated
+        self.db = connect_db(db_path)
+        with self.lock, self.db:
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS chat_turns (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user TEXT NOT NULL,
+                    question TEXT NOT NULL,
+                    answer TEXT NOT NULL,
+                    input_tokens INTEGER NOT NULL,
+                    output_tokens INTEGER NOT NULL,
+                    created REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS chat_turns_user ON chat_turns(user, id);
+                CREATE TABLE IF NOT EXISTS chat_summaries (
+                    user TEXT PRIMARY KEY,
+                    summary TEXT NOT NULL,
+                    through_id INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS chat_threads (
+                    user TEXT PRIMARY KEY,
+                    after_id INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS chat_turns_created ON chat_turns(created);
+            """)
+
+    # Turns of sessions that are not logged in ("session:<id>" users) expire CHAT_SESSION_TTL after they were
+    # asked, since nobody can come back to them once the session is gone
+    def add_turn(self, user, question, answer, input_tokens, output_tokens):
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO chat_turns (user, question, answer, input_tokens, output_tokens, created) VALUES (?, ?, ?, ?, ?, ?)",
+                (user, question, answer, input_tokens, output_tokens, now),
+            )
+            self.db.execute("DELETE FROM chat_turns WHERE created < ? AND user LIKE 'session:%'", (now - CHAT_SESSION_TTL,))
+            for table in ("chat_summaries", "chat_threads"):
+                self.db.execute(f"DELETE FROM {table} WHERE user LIKE 'session:%' AND user NOT IN (SELECT user FROM chat_turns)")
+
+    # Start a new conversation: earlier turns are kept but no longer sent with questions
+    def start_thread(self, user):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO chat_threads SELECT ?, COALESCE(MAX(id), 0) FROM chat_turns WHERE user = ?", (user, user)
+            )
+            self.db.execute("DELETE FROM chat_summaries WHERE user = ?", (user,))
+
+    # The history to send with the next question: the running summary plus the newest turns of the current
+    # conversation that fit in `budget` tokens, oldest first. Unsummarized turns that no longer fit are
+    # returned as `older`; `last_at` is when the newest turn was asked.
+    def window(self, user, budget):
+        with self.lock:
+            row = self.db.execute("SELECT after_id FROM chat_threads WHERE user = ?", (user,)).fetchone()
+            after_id = row[0] if row else 0
+            row = self.db.execute("SELECT summary, through_id FROM chat_summaries WHERE user = ?", (user,)).fetchone()
+            summary, through_id = row if row else ("", 0)
+            rows = self.db.execute(
+                "SELECT id, question, answer, created FROM chat_turns WHERE user = ? AND id > ? ORDER BY id DESC LIMIT ?",
+                (user, max(through_id, after_id), CHAT_MAX_TURNS),
+            ).fetchall()
+            turn_count = self.db.execute("SELECT COUNT(*) FROM chat_turns WHERE user = ? AND id > ?", (user, after_id)).fetchone()[0]
+        last_at = rows[0][3] if rows else None
+        rows = [row[:3] for row in rows]
+        tokens = estimate_tokens(summary)
+        turns = []
+        for index, (turn_id, question, answer) in enumerate(rows):
+            turn_tokens = estimate_tokens(question) + estimate_tokens(answer)
+            if turns and tokens + turn_tokens > budget:
+                older = [{"id": turn_id, "question": question, "answer": answer} for turn_id, question, answer in reversed(rows[index:])]
+                break
+            tokens += turn_tokens
+            turns.append({"id": turn_id, "question": question, "answer": answer})
+        else:
+            older = []
+        return {"summary": summary, "turns": turns[::-1], "older": older, "tokens": tokens, "turn_count": turn_count, "last_at": last_at}
+
+    def set_summary(self, user, summary, through_id):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO chat_summaries VALUES (?, ?, ?)", (user, summary, through_id))
+
+    def clear(self, user):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM chat_turns WHERE user = ?", (user,))
+            self.db.execute("DELETE FROM chat_summaries WHERE user = ?", (user,))
+            self.db.execute("DELETE FROM chat_threads WHERE user = ?", (user,))
+
+@st.cache_resource(show_spinner=False)
+def get_chat_store(db_path):
+    return ChatStore(db_path)
+
+def chat_transcript(window, message):
+    lines = [f"Summary of our earlier conversation: {window['summary']}", ""] if window["summary"] else []
+    for turn in window["turns"]:
+        lines += [f"User: {turn['question']}", f"Assistant: {turn['answer']}"]
+    return "\n".join(lines + [f"User: {message}", "Assistant:"])
+
+# Stream a follow-up answer with the bounded history. Gemini gets it through its chat API, which also reports
+# exact token usage; other backends get a plain transcript and estimated counts.
+def stream_chat(model, window, message, usage):
+    usage.update(input_tokens=estimate_tokens(chat_transcript(window, message)), output_tokens=0)
+    if hasattr(model, "start_chat"):
+        history = []
+        if window["summary"]:
+            history += [
+                {"role": "user", "parts": [f"Summary of our earlier conversation: {window['summary']}"]},
+                {"role": "model", "parts": ["Understood."]},
+            ]
+        for turn in window["turns"]:
+            history += [{"role": "user", "parts": [turn["question"]]}, {"role": "model", "parts": [turn["answer"]]}]
+
+        def open_stream():
+            for chunk in model.start_chat(history=history).send_message(message, stream=True):
+                metadata = getattr(chunk, "usage_metadata", None)
+                if metadata is not None and metadata.prompt_token_count:
+                    usage.update(input_tokens=metadata.prompt_token_count, output_tokens=metadata.candidates_token_count)
+                yield chunk.text
+    else:
+        prompt = chat_transcript(window, message)
+        open_stream = lambda: (chunk.text for chunk in model.generate_content(prompt, stream=True))
+    dispatcher = get_dispatcher(GENERATION_CONCURRENCY, GENERATION_RATE, GENERATION_BURST, GENERATION_RETRIES)
+    parts = []
+    with get_metrics().span("llm_chat"):
+        for text in dispatcher.stream(open_stream, GENERATION_DEADLINE):
+            parts.append(text)
+            yield text
+    if not usage["output_tokens"]:
+        usage["output_tokens"] = estimate_tokens("".join(parts))
+
+# Fold the turns that slid out of the window into the running summary, on a background thread
+def summarize_older_turns(model, chat_store, user):
+    window = chat_store.window(user, CHAT_HISTORY_TOKENS)
+    if not window["older"]:
+        return
+    with chat_store.lock:
+        if user in chat_store.summarizing:
+            return
+        chat_store.summarizing.add(user)
+    turns = "\n".join(f"User: {turn['question']}\nAssistant: {turn['answer']}" for turn in window["older"])
+    prompt = (
+        f"Update the running summary of a rooftop gardening conversation with the new turns below. "
+        f"Keep the user's plants, conditions and decisions, in at most {CHAT_SUMMARY_WORDS} words.\n\n"
+        f"Current summary: {window['summary'] or 'none'}\n\nNew turns:\n{turns}"
+    )
+    dispatcher = get_dispatcher(GENERATION_CONCURRENCY, GENERATION_RATE, GENERATION_BURST, GENERATION_RETRIES)
+
+    def summarize():
+        try:
+            summary = dispatcher.submit(lambda: model.generate_content(prompt).text, GENERATION_DEADLINE)
+            chat_store.set_summary(user, summary.strip(), window["older"][-1]["id"])
+        except Exception:
+            logger.exception("Updating the chat summary failed")
+        finally:
+            with chat_store.lock:
+                chat_store.summarizing.discard(user)
+
+    threading.Thread(target=summarize, daemon=True, name="chat-summary").start()
+
+# Approximate bytes held by a session's state: containers are walked, everything else counted by its own size
+def deep_size(value, seen=None):
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_size(key, seen) + deep_size(item, seen) for key, item in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in value)
+    return size
+
+# Latest state size of every session seen within `ttl` seconds, to show that it stays flat as sessions scale
+class SessionFootprints:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.sessions = {}  # Session id -> (bytes, last seen)
+        self.stats = {"sessions": 0, "mean_bytes": 0, "max_bytes": 0, "total_bytes": 0}
+
+    def record(self, session_id, size):
+        now = time.time()
+        with self.lock:
+            self.sessions[session_id] = (size, now)
+            self.sessions = {key: entry for key, entry in self.sessions.items() if now - entry[1] < self.ttl}
+            sizes = [size for size, _ in self.sessions.values()]
+            self.stats.update(sessions=len(sizes), mean_bytes=sum(sizes) // len(sizes), max_bytes=max(sizes), total_bytes=sum(sizes))
+
+@st.cache_resource(show_spinner=False)
+def get_session_footprints():
+    return get_metrics().watch("sessions", SessionFootprints(SESSION_REPORT_TTL))
+
+# Local store of pre-generated answers for the Prompts catalog, keyed by prompt id
+class PromptAnswerStore:
+    def __init__(self, db_path):
+        self.lock = threading.Lock()
+        self.db = connect_db(db_path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS prompt_answers (prompt_id INTEGER PRIMARY KEY, answer TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self.db.commit()
+
+    def get(self, prompt_id):
+        with self.lock:
+            row = self.db.execute("SELECT answer FROM prompt_answers WHERE prompt_id = ?", (prompt_id,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, prompt_id, answer):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO prompt_answers VALUES (?, ?, ?)", (prompt_id, answer, time.time()))
+            self.db.commit()
+
+    def count(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM prompt_answers").fetchone()[0]
+
+@st.cache_resource(show_spinner=False)
+def get_prompt_answer_store(db_path):
+    return PromptAnswerStore(db_path)
+
+# One pre-warm job per process, so repeated clicks never start overlapping batches
+@st.cache_resource(show_spinner=False)
+def get_prewarm_job():
+    return {"lock": threading.Lock(), "thread": None, "done": 0, "failed": 0, "total": 0}
+
+# Generate answers for the given prompts with at most PREWARM_WORKERS calls in flight
+def prewarm_prompt_answers(model, store, cache, job, prompts):
+    def generate(prompt):
+        store.put(prompt.id, answer_question(model, prompt.text, cache)["text"])
+
+    with ThreadPoolExecutor(max_workers=PREWARM_WORKERS) as pool:
+        for future in as_completed([pool.submit(generate, prompt) for prompt in prompts]):
+            if future.exception() is None:
+                job["done"] += 1
+            else:
+                job["failed"] += 1
+
+# Start the pre-warm job in the background for every prompt without a stored answer
+def start_prewarm(model, store, job):
+    with job["lock"]:
+        if job["thread"] is not None and job["thread"].is_alive():
+            return
+        pending = [prompt for prompt in PROMPTS if store.get(prompt.id) is None]
+        cache = get_response_cache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_DB)
+        job.update(done=0, failed=0, total=len(pending))
+        job["thread"] = threading.Thread(
+            target=prewarm_prompt_answers, args=(model, store, cache, job, pending), daemon=True
+        )
+        job["thread"].start()
+
+# Forum posts and replies in SQLite, shared by every session and worker process.
+# All forum reads and writes go through these methods so the backend can be swapped in get_forum_store().
+class ForumStore:
+    def __init__(self, db_path):
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()  # Read results shared by every session, cleared on each write
+        self.db = connect_db(db_path)
+        self.version = None  # data_version the cache was filled at; other workers' writes change it
+        with self.lock, self.db:
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS posts (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    timestamp TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS replies (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    post_id INTEGER NOT NULL REFERENCES posts(id),
+                    user TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    timestamp TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS posts_timestamp ON posts(timestamp);
+                CREATE INDEX IF NOT EXISTS posts_user ON posts(user);
+                CREATE INDEX IF NOT EXISTS replies_post ON replies(post_id, timestamp);
+                CREATE INDEX IF NOT EXISTS replies_user ON replies(user);
+            """)
+            # Full-text index over posts and replies, kept up to date on every insert
+            try:
+                self.db.execute(
+                    """
+                    CREATE VIRTUAL TABLE IF NOT EXISTS forum_search USING fts5(
+                        content, user, kind UNINDEXED, post_id UNINDEXED, timestamp UNINDEXED, prefix='2 3'
+                    )
+                    """
+                )
+                self.has_fts = True
+            except sqlite3.OperationalError:  # SQLite built without FTS5
+                self.has_fts = False
+            if self.has_fts and not self.db.execute("SELECT 1 FROM forum_search LIMIT 1").fetchone():
+                self.db.execute(
+                    """
+                    INSERT INTO forum_search (content, user, kind, post_id, timestamp)
+                    SELECT content, user, 'post', id, timestamp FROM posts
+                    UNION ALL
+                    SELECT content, user, 'reply', post_id, timestamp FROM replies
+                    """
+                )
+
+    def add_post(self, user, content, timestamp):
+        with self.lock, self.db:
+            cursor = self.db.execute(
+                "INSERT INTO posts (user, content, timestamp) VALUES (?, ?, ?)", (user, content, timestamp.isoformat())
+            )
+            self._index(content, user, "post", cursor.lastrowid, timestamp)
+            self.cache.clear()
+        return cursor.lastrowid
+
+    def add_reply(self, post_id, user, content, timestamp):
+        with self.lock, self.db:
+            cursor = self.db.execute(
+                "INSERT INTO replies (post_id, user, content, timestamp) VALUES (?, ?, ?, ?)",
+                (post_id, user, content, timestamp.isoformat()),
+            )
+            self._index(content, user, "reply", post_id, timestamp)
+            self.cache.clear()
+        return cursor.lastrowid
+
+    POST_COLUMNS = "p.id, p.user, p.content, p.timestamp, (SELECT COUNT(*) FROM replies r WHERE r.post_id = p.id)"
+
+    # One page of posts, newest first, starting below before_id; also reports whether older posts exist
+    def list_posts(self, before_id=None, limit=20):
+        return self._cached(("page", before_id, limit), lambda: self._load_page(before_id, limit))
+
+    def get_post(self, post_id):
+        return self._cached(("post", post_id), lambda: self._post(
+            self.db.execute(f"SELECT {self.POST_COLUMNS} FROM posts p WHERE p.id = ?", (post_id,)).fetchone()
+        ))
+
+    def list_replies(self, post_id, limit=50):
+        return self._cached(("replies", post_id, limit), lambda: tuple(
+            ReplyRecord(user, content, datetime.fromisoformat(timestamp))
+            for user, content, timestamp in self.db.execute(
+                "SELECT user, content, timestamp FROM replies WHERE post_id = ? ORDER BY id LIMIT ?", (post_id, limit)
+            )
+        ))
+
+    # (id, content) of up to `limit` posts after after_id, oldest first. Read straight from the database for bulk
+    # scans such as the semantic index backfill, which would otherwise flush the pages sessions share from the cache.
+    def scan_posts(self, after_id, limit):
+        with self.lock:
+            return self.db.execute("SELECT id, content FROM posts WHERE id > ? ORDER BY id LIMIT ?", (after_id, limit)).fetchall()
+
+    def _load_page(self, before_id, limit):
+        rows = self.db.execute(
+            f"SELECT {self.POST_COLUMNS} FROM posts p WHERE p.id < ? ORDER BY p.id DESC LIMIT ?",
+            (before_id if before_id is not None else 2**63 - 1, limit + 1),
+        ).fetchall()
+        posts = tuple(self._post(row) for row in rows[:limit])
+        for post in posts:
+            self._remember(("post", post.id), post)
+        return posts, len(rows) > limit
+
+    def _post(self, row):
+        post_id, user, content, timestamp, reply_count = row
+        return PostRecord(post_id, user, content, datetime.fromisoformat(timestamp), reply_count)
+
+    # Pages, posts and replies are read once per process and shared by every session until the next write
+    def _cached(self, key, load):
+        with self.lock:
+            version = data_version(self.db)
+            if version != self.version:
+                self.cache.clear()
+                self.version = version
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            value = load()
+            self._remember(key, value)
+            return value
+
+    def _remember(self, key, value):
+        self.cache[key] = value
+        self.cache.move_to_end(key)
+        while len(self.cache) > FORUM_CACHE_ENTRIES:
+            self.cache.popitem(last=False)
+
+    # Ranked prefix search over posts and replies, with matches highlighted in bold. Only the newest
+    # FORUM_SEARCH_RANKED matches are ranked: they are found by walking the index backwards by rowid,
+    # which is cheap, while ranking costs a BM25 score per match.
+    def search(self, query, limit=20):
+        terms = re.findall(r"\w+", query.lower())
+        if not terms:
+            return []
+        match = " ".join(f'"{term}"*' if len(term) >= FORUM_SEARCH_MIN_PREFIX else f'"{term}"' for term in terms)
+        with self.lock:
+            if self.has_fts:
+                rows = self.db.execute(
+                    """
+                    SELECT kind, post_id, user, snippet(forum_search, 0, '**', '**', '…', 24), timestamp
+                    FROM forum_search
+                    WHERE forum_search MATCH ?1 AND rowid >= (
+                        SELECT COALESCE(MIN(rowid), 0) FROM (
+                            SELECT rowid FROM forum_search WHERE forum_search MATCH ?1 ORDER BY rowid DESC LIMIT ?2
+                        )
+                    )
+                    ORDER BY rank, rowid DESC
+                    LIMIT ?3
+                    """,
+                    (match, FORUM_SEARCH_RANKED, limit),
+                ).fetchall()
+            else:
+                pattern = f"%{' '.join(terms)}%"
+                rows = self.db.execute(
+                    """
+                    SELECT 'post', id, user, content, timestamp FROM posts WHERE content LIKE ?
+                    UNION ALL
+                    SELECT 'reply', post_id, user, content, timestamp FROM replies WHERE content LIKE ?
+                    ORDER BY timestamp DESC
+                    LIMIT ?
+                    """,
+                    (pattern, pattern, limit),
+                ).fetchall()
+        return [
+            {"kind": kind, "post_id": post_id, "user": user, "snippet": snippet, "timestamp": datetime.fromisoformat(timestamp)}
+            for kind, post_id, user, snippet, timestamp in rows
+        ]
+
+    def _index(self, content, user, kind, post_id, timestamp):
+        if self.has_fts:
+            self.db.execute(
+                "INSERT INTO forum_search (content, user, kind, post_id, timestamp) VALUES (?, ?, ?, ?, ?)",
+                (content, user, kind, post_id, timestamp.isoformat()),
+            )
+
+@st.cache_resource(show_spinner=False)
+def get_forum_store(db_path):
+    return ForumStore(db_path)
+
+# Local CPU sentence embeddings, normalized so that a dot product is the cosine similarity
+class SentenceEmbedder:
+    def __init__(self, model_name):
+        self.model = heavy_import("sentence_transformers").SentenceTransformer(model_name, device="cpu")
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self.reuse_threshold = SEMANTIC_REUSE_THRESHOLD
+
+    def embed(self, texts):
+        return self.model.encode(texts, batch_size=64, normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+
+# Dependency-free fallback that hashes words and word pairs into a fixed number of buckets. It matches
+# rewordings that share vocabulary, and serves installs without sentence-transformers and the fake backend.
+# Its matches are only used as context: questions differing in one word ("tomatoes" vs "chillies") score
+# above any threshold that still catches rewordings, so stored answers are never reused from it.
+class HashingEmbedder:
+    def __init__(self, dim=512):
+        self.dim = dim
+        self.reuse_threshold = None
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = normalize_question(text).split()
+            for feature in words + [f"{first} {second}" for first, second in zip(words, words[1:])]:
+                vectors[row, zlib.crc32(feature.encode()) % self.dim] += 1.0
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+# Embedding index over prompt texts, generated answers and forum posts. Vectors live in a memory-mapped
+# float32 matrix that grows by doubling, one row per entry; entry metadata lives in SQLite keyed by row.
+# Search is a brute-force dot product over all rows followed by a partial sort for the top k.
+class SemanticIndex:
+    def __init__(self, directory, embedder):
+        os.makedirs(directory, exist_ok=True)
+        self.embedder = embedder
+        self.path = os.path.join(directory, "vectors.f32")
+        self.lock = threading.Lock()
+        self.db = connect_db(os.path.join(directory, "entries.db"))
+        with self.lock, self.db:
+            self.db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    row INTEGER PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    ref TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    answer TEXT,
+                    UNIQUE (kind, ref)
+                )
+                """
+            )
+        self.size = 0
+        self.version = None  # data_version self.size was read at; other workers' additions change it
+        self.vectors = None
+        with self.lock:
+            self._refresh()
+
+    # Add (kind, ref, text, answer) entries; known entries only have their answer updated.
+    # Rows are allocated inside an IMMEDIATE transaction, so worker processes sharing the directory take turns appending.
+    def add(self, entries):
+        with self.lock, self.db:
+            new = [entry for entry in entries if not self._update(*entry)]
+        if not new:
+            return
+        vectors = self.embedder.embed([text for _, _, text, _ in new])
+        with self.lock, self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self._refresh()
+            for entry, vector in zip(new, vectors):
+                if self._update(*entry):  # Added by another thread or worker while embedding
+                    continue
+                self._reserve(self.size + 1)
+                self.vectors[self.size] = vector
+                self.db.execute("INSERT INTO entries VALUES (?, ?, ?, ?, ?)", (self.size, *entry))
+                self.size += 1
+            self.vectors.flush()
+
+    # The k most similar entries to text, most similar first
+    def search(self, text, k):
+        query = self.embedder.embed([text])[0]
+        with self.lock:
+            self._refresh()
+            size, vectors = self.size, self.vectors
+        if size == 0:
+            return []
+        scores = vectors[:size] @ query
+        top = np.argpartition(-scores, min(k, size) - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        with self.lock:
+            rows = {
+                row: (kind, ref, text, answer)
+                for row, kind, ref, text, answer in self.db.execute(
+                    f"SELECT row, kind, ref, text, answer FROM entries WHERE row IN ({','.join('?' * len(top))})", [int(row) for row in top]
+                )
+            }
+        return [
+            {"score": float(scores[row]), "kind": rows[row][0], "ref": rows[row][1], "text": rows[row][2], "answer": rows[row][3]}
+            for row in top
+            if row in rows
+        ]
+
+    def _update(self, kind, ref, text, answer):
+        if not self.db.execute("SELECT 1 FROM entries WHERE kind = ? AND ref = ?", (kind, ref)).fetchone():
+            return False
+        if answer is not None:
+            self.db.execute("UPDATE entries SET answer = ? WHERE kind = ? AND ref = ?", (answer, kind, ref))
+        return True
+
+    # Pick up rows other workers have appended, remapping the file if it has grown past our mapping
+    def _refresh(self):
+        version = data_version(self.db)
+        if version == self.version:
+            return
+        self.version = version
+        self.size = self.db.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM entries").fetchone()[0]
+        self._reserve(max(self.size, 1))
+
+    # Make room for `rows` rows, doubling the file when it is full
+    def _reserve(self, rows):
+        if self.vectors is not None and len(self.vectors) >= rows:
+            return
+        capacity = max(1024, len(self.vectors) * 2 if self.vectors is not None else 0)
+        while capacity < rows:
+            capacity *= 2
+        if self.vectors is not None:
+            self.vectors.flush()
+        if os.path.exists(self.path):  # Another worker may have grown the file already; never shrink it
+            capacity = max(capacity, os.path.getsize(self.path) // (4 * self.embedder.dim))
+        with open(self.path, "ab") as f:
+            f.truncate(capacity * self.embedder.dim * 4)
+        self.vectors = np.memmap(self.path, dtype=np.float32, mode="r+", shape=(capacity, self.embedder.dim))
+
+# Index the prompts catalog and existing forum posts in the background, so the first search is not held up
+def backfill_semantic_index(index, forum_store):
+    index.add([("prompt", str(prompt.id), prompt.text, None) for prompt in PROMPTS])
+    after_id = 0
+    while True:
+        posts = forum_store.scan_posts(after_id, 500)
+        if not posts:
+            break
+        index.add([("post", str(post_id), content, None) for post_id, content in posts])
+        after_id = posts[-1][0]
+
+# One index per process and embedding model. Falls back to the hashing embedder when sentence-transformers
+# is missing or the model cannot be loaded (e.g. no network to download it).
+@st.cache_resource(show_spinner="Loading the semantic index... 🧭")
+def get_semantic_index(directory, embedding_model):
+    if embedding_model != "hash":
+        try:
+            embedder = SentenceEmbedder(embedding_model)
+        except Exception as e:
+            logger.warning("Could not load %s (%s); using the hashing embedder", embedding_model, e)
+            embedding_model, embedder = "hash", HashingEmbedder()
+    else:
+        embedder = HashingEmbedder()
+    index = SemanticIndex(os.path.join(directory, re.sub(r"\W+", "-", embedding_model)), embedder)
+    threading.Thread(target=backfill_semantic_index, args=(index, get_forum_store(FORUM_DB)), daemon=True, name="semantic-backfill").start()
+    return index
+
+# Queue entries for the semantic index. They are embedded on the indexer thread, so the caller never waits for
+# the embedding model to load or run, and the index only improves answers, so failing to update it fails nobody.
+def index_entries(entries):
+    get_index_queue().put(entries)
+
+# One indexer thread per process, started with its queue
+@st.cache_resource(show_spinner=False)
+def get_index_queue():
+    pending = queue.Queue()
+    threading.Thread(target=run_indexer, args=(pending,), daemon=True, name="semantic-indexer").start()
+    return pending
+
+# Add whatever has queued up since the last batch in one call, so a burst of posts is embedded together
+def run_indexer(pending):
+    while True:
+        entries = list(pending.get())
+        while not pending.empty():
+            entries.extend(pending.get_nowait())
+        try:
+            get_semantic_index(SEMANTIC_INDEX_DIR, EMBEDDING_MODEL).add(entries)
+        except Exception:
+            logger.exception("Could not add %d entries to the semantic index", len(entries))
+
+# Look up a question in the semantic index: a near-duplicate's answer to reuse, and related snippets for context.
+# Prompts carry their pre-warmed answer and forum posts their first reply; forum replies are only used as context.
+# Best-effort like index_entries: when the index cannot be searched the question is answered without retrieval.
+def retrieve(question):
+    try:
+        with get_metrics().span("semantic_search"):
+            index = get_semantic_index(SEMANTIC_INDEX_DIR, EMBEDDING_MODEL)
+            hits = index.search(question, SEMANTIC_TOP_K)
+        for hit in hits:
+            if hit["kind"] == "prompt":
+                hit["answer"] = get_prompt_answer_store(PROMPT_ANSWER_DB).get(int(hit["ref"]))
+            elif hit["kind"] == "post":
+                replies = get_forum_store(FORUM_DB).list_replies(int(hit["ref"]), 1)
+                hit["answer"] = replies[0].content if replies else None
+    except Exception:
+        logger.exception("Semantic search failed; answering without retrieval")
+        return None, []
+    threshold = index.embedder.reuse_threshold
+    reuse = next(
+        (hit for hit in hits if threshold is not None and hit["score"] >= threshold and hit["answer"] and hit["kind"] != "post"), None
+    )
+    context = [hit for hit in hits if hit["score"] >= SEMANTIC_CONTEXT_THRESHOLD]
+    return reuse, context
+
+# Prepend related snippets to the question, each cut to SEMANTIC_SNIPPET_CHARS to bound the prompt size
+def with_context(question, context):
+    if not context:
+        return question
+    notes = "\n".join(
+        f"- {hit['text'][:SEMANTIC_SNIPPET_CHARS]}" + (f" → {hit['answer'][:SEMANTIC_SNIPPET_CHARS]}" if hit["answer"] else "")
+        for hit in context
+    )
+    return f"Related notes from this app's prompts and community forum; use them if they help.\n{notes}\n\nQuestion: {question}"
+
+# Reminder deadlines for every user and plant, persisted in SQLite and owned by one scheduler thread per process.
+# The thread sleeps on a min-heap of due times until the next deadline and queues an alert for its user.
+class ReminderScheduler:
+    def __init__(self, db_path):
+        self.db = connect_db(db_path)
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.reminders = {}  # (user, plant, kind) -> {"interval": seconds, "started": epoch seconds}
+        self.by_user = {}  # user -> set of reminder keys
+        self.versions = {}  # user -> bumped on every change, invalidating that user's cached arrays
+        self.views = {}  # user -> NumPy arrays of that user's reminders, see user_view()
+        self.heap = []  # (due time, key); entries left behind by a reset are skipped when popped
+        self.alerts = {}  # user -> {(plant, kind)} that fell due since the panel last showed them
+        self.version = None  # data_version the timers were loaded at; other workers' writes change it
+        with self.db:
+            self.db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS reminders (
+                    user TEXT NOT NULL,
+                    plant TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    interval REAL NOT NULL,
+                    started REAL NOT NULL,
+                    PRIMARY KEY (user, plant, kind)
+                )
+                """
+            )
+        with self.lock:
+            self._sync()
+        threading.Thread(target=self._run, daemon=True, name="reminder-scheduler").start()
+
+    # Give a user the default reminders the first time they log in; existing timers are left running
+    def ensure_defaults(self, user):
+        with self.wakeup:
+            self._sync()
+            if self.by_user.get(user):
+                return
+        for plant, kind, interval in DEFAULT_REMINDERS:
+            self.set_reminder(user, plant, kind, interval)
+
+    # Add a plant with its own watering and fertilizing cadence, or change an existing plant's cadence
+    def add_plant(self, user, plant, water_interval, fertilizer_interval):
+        self.set_reminder(user, plant, "water", water_interval)
+        self.set_reminder(user, plant, "fertilizer", fertilizer_interval)
+
+    def set_reminder(self, user, plant, kind, interval):
+        with self.wakeup:
+            self._sync()
+            key = (user, plant, kind)
+            started = self.reminders[key]["started"] if key in self.reminders else time.time()
+            with self.db:
+                self.db.execute("INSERT OR REPLACE INTO reminders VALUES (?, ?, ?, ?, ?)", (*key, interval, started))
+            self._schedule(key, interval, started)
+            self.wakeup.notify()
+
+    def remove_plant(self, user, plant):
+        with self.wakeup:
+            self._sync()
+            with self.db:
+                self.db.execute("DELETE FROM reminders WHERE user = ? AND plant = ?", (user, plant))
+            for key in [key for key in self.by_user.get(user, ()) if key[1] == plant]:
+                del self.reminders[key]
+                self.by_user[user].discard(key)
+            if user in self.alerts:
+                self.alerts[user] = {alert for alert in self.alerts[user] if alert[0] != plant}
+            self.versions[user] = self.versions.get(user, 0) + 1
+
+    # Restart a reminder's timer, e.g. after the plant has been watered. A plant removed meanwhile,
+    # in another tab or worker, is left removed.
+    def reset(self, user, plant, kind):
+        with self.wakeup:
+            self._sync()
+            key = (user, plant, kind)
+            if key not in self.reminders:
+                return
+            started = time.time()
+            with self.db:
+                self.db.execute("UPDATE reminders SET started = ? WHERE user = ? AND plant = ? AND kind = ?", (started, *key))
+            self._schedule(key, self.reminders[key]["interval"], started)
+            self.alerts.get(user, set()).discard((plant, kind))
+            self.wakeup.notify()
+
+    # A user's reminders as NumPy arrays plus an index sorted by due time, rebuilt only after they change.
+    # Every timer advances at the same rate, so the due-time order stays valid until the next change.
+    def user_view(self, user):
+        with self.lock:
+            self._sync()
+            version = self.versions.get(user, 0)
+            view = self.views.get(user)
+            if view is None or view["version"] != version:
+                keys = sorted(self.by_user.get(user, ()))
+                started = np.array([self.reminders[key]["started"] for key in keys], dtype=np.float64)
+                interval = np.array([self.reminders[key]["interval"] for key in keys], dtype=np.float64)
+                due = started + interval
+                view = {
+                    "version": version,
+                    "plants": [key[1] for key in keys],
+                    "kinds": [key[2] for key in keys],
+                    "started": started,
+                    "interval": interval,
+                    "due": due,
+                    "order": np.argsort(due, kind="stable"),
+                }
+                self.views[user] = view
+            return view
+
+    def pop_alerts(self, user):
+        with self.lock:
+            return sorted(self.alerts.pop(user, set()))
+
+    # Reload every timer once another worker has changed the table, dropping alerts it has since reset.
+    # Called with the lock held; the scheduler thread is woken in case a reloaded timer is due sooner.
+    def _sync(self):
+        version = data_version(self.db)
+        if version == self.version:
+            return
+        self.version = version
+        rows = self.db.execute("SELECT * FROM reminders").fetchall()
+        self.reminders.clear()
+        self.by_user.clear()
+        self.heap.clear()
+        for user in self.versions:
+            self.versions[user] += 1
+        for user, plant, kind, interval, started in rows:
+            self._schedule((user, plant, kind), interval, started)
+        now = time.time()
+        for user, alerts in self.alerts.items():
+            alerts.intersection_update(
+                key[1:] for key in self.by_user.get(user, ()) if self.reminders[key]["started"] + self.reminders[key]["interval"] <= now
+            )
+        self.wakeup.notify()
+
+    def _schedule(self, key, interval, started):
+        self.reminders[key] = {"interval": interval, "started": started}
+        self.by_user.setdefault(key[0], set()).add(key)
+        self.versions[key[0]] = self.versions.get(key[0], 0) + 1
+        heapq.heappush(self.heap, (started + interval, key))
+
+    def _run(self):
+        with self.wakeup:
+            while True:
+                now = time.time()
+                while self.heap and self.heap[0][0] <= now:
+                    due, key = heapq.heappop(self.heap)
+                    reminder = self.reminders.get(key)
+                    if reminder is not None and reminder["started"] + reminder["interval"] == due:
+                        self.alerts.setdefault(key[0], set()).add(key[1:])
+                self.wakeup.wait(self.heap[0][0] - now if self.heap else None)
+
+@st.cache_resource(show_spinner=False)
+def get_reminder_scheduler(db_path):
+    return ReminderScheduler(db_path)
+
+# Accounts in SQLite with salted scrypt password hashes, shared by every session and worker.
+# Password checks run on a small thread pool rather than the script thread: hashlib.scrypt releases the GIL,
+# and the pool bounds the memory concurrent logins can take. Failed logins are throttled per user and per
+# client address, and signed tokens let a session log back in without its password.
+class UserStore:
+    def __init__(self, db_path, secret=None):
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS, thread_name_prefix="password-hash")
+        self.stats = {"logins": 0, "failed": 0, "throttled": 0, "token_logins": 0}
+        self.db = connect_db(db_path)
+        with self.lock, self.db:
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS users (
+                    name TEXT PRIMARY KEY,
+                    password_hash TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    token_generation INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE TABLE IF NOT EXISTS login_failures (
+                    key TEXT NOT NULL,
+                    at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS login_failures_key ON login_failures(key, at);
+                CREATE TABLE IF NOT EXISTS secrets (
+                    name TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                );
+            """)
+            if "token_generation" not in [column[1] for column in self.db.execute("PRAGMA table_info(users)")]:
+                self.db.execute("ALTER TABLE users ADD COLUMN token_generation INTEGER NOT NULL DEFAULT 0")
+            self.db.execute("INSERT OR IGNORE INTO secrets VALUES ('session', ?)", (secrets.token_hex(32),))
+            stored_secret = self.db.execute("SELECT value FROM secrets WHERE name = 'session'").fetchone()[0]
+            empty = self.db.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0
+        self.secret = (secret or stored_secret).encode()
+        self.decoy = self.hash_password(secrets.token_hex(16))  # Checked for unknown users, so they take as long as a wrong password
+        if empty:
+            for name in SEED_USERS:
+                self.add_user(name, SEED_PASSWORD)
+
+    # "scrypt$n$r$p$salt$digest", keeping the cost parameters so they can be raised for new hashes later
+    def hash_password(self, password, salt=None):
+        salt = salt or os.urandom(16)
+        digest = hashlib.scrypt(password.encode(), salt=salt, dklen=32, maxmem=64 * 2**20, **PASSWORD_HASH)
+        return f"scrypt${PASSWORD_HASH['n']}${PASSWORD_HASH['r']}${PASSWORD_HASH['p']}${salt.hex()}${digest.hex()}"
+
+    def add_user(self, name, password):
+        password_hash = self.executor.submit(self.hash_password, password).result()
+        with self.lock, self.db:
+            self.db.execute("INSERT OR IGNORE INTO users (name, password_hash, created) VALUES (?, ?, ?)", (name, password_hash, time.time()))
+
+    def authenticate(self, name, password, client=None):
+        keys = [f"user:{name}"] + ([f"client:{client}"] if client else [])
+        now = time.time()
+        with self.lock:
+            failures = [
+                self.db.execute("SELECT COUNT(*) FROM login_failures WHERE key = ? AND at > ?", (key, now - LOGIN_WINDOW)).fetchone()[0]
+                for key in keys
+            ]
+            row = self.db.execute("SELECT password_hash FROM users WHERE name = ?", (name,)).fetchone()
+        if max(failures) >= LOGIN_ATTEMPTS:
+            self.stats["throttled"] += 1
+            return "throttled"
+        valid = self.executor.submit(self._check, password, row[0] if row else self.decoy).result() and row is not None
+        with self.lock, self.db:
+            if valid:
+                self.db.execute("DELETE FROM login_failures WHERE key = ?", (keys[0],))
+            else:
+                self.db.executemany("INSERT INTO login_failures VALUES (?, ?)", [(key, now) for key in keys])
+                self.db.execute("DELETE FROM login_failures WHERE at < ?", (now - LOGIN_WINDOW,))
+        self.stats["logins" if valid else "failed"] += 1
+        return "ok" if valid else "invalid"
+
+    # Signed "name.generation.expiry.signature" token, accepted by every worker sharing USER_DB or ROOFTOP_SESSION_SECRET
+    def issue_token(self, name):
+        payload = f"{name}.{self._generation(name)}.{int(time.time() + SESSION_TTL)}"
+        return f"{payload}.{self._sign(payload)}"
+
+    # The user a token was issued to, or None when it is forged, expired, revoked or malformed. Tokens come from
+    # the client, so the fields are checked to be ASCII digits and hex before int() and compare_digest see them.
+    def check_token(self, token):
+        payload, _, signature = token.rpartition(".")
+        head, _, expires = payload.rpartition(".")
+        name, _, generation = head.rpartition(".")
+        if not name or not re.fullmatch(r"[0-9]+", generation) or not re.fullmatch(r"[0-9]+", expires):
+            return None
+        if not re.fullmatch(r"[0-9a-f]{64}", signature) or int(expires) < time.time():
+            return None
+        if not hmac.compare_digest(signature, self._sign(payload)) or int(generation) != self._generation(name):
+            return None
+        self.stats["token_logins"] += 1
+        return name
+
+    # Invalidate every token issued to a user so far, e.g. on logout, including cookies left in other browsers
+    def revoke_tokens(self, name):
+        with self.lock, self.db:
+            self.db.execute("UPDATE users SET token_generation = token_generation + 1 WHERE name = ?", (name,))
+
+    def _generation(self, name):
+        with self.lock:
+            row = self.db.execute("SELECT token_generation FROM users WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else -1
+
+    def _check(self, password, stored):
+        _, n, r, p, salt, digest = stored.split("$")
+        candidate = hashlib.scrypt(password.encode(), salt=bytes.fromhex(salt), n=int(n), r=int(r), p=int(p), dklen=32, maxmem=64 * 2**20)
+        return hmac.compare_digest(candidate, bytes.fromhex(digest))
+
+    def _sign(self, payload):
+        return hmac.new(self.secret, payload.encode(), hashlib.sha256).hexdigest()
+
+@st.cache_resource(show_spinner=False)
+def get_user_store(db_path):
+    return get_metrics().watch("users", UserStore(db_path, SESSION_SECRET))
+
+# Login token the browser sent with the request that opened this session, or None, also where there is no
+# browser, e.g. in tests. st.context.cookies only holds that request's cookies, so later cookie changes show up
+# in new sessions only.
+def read_session_cookie():
+    token = st.context.cookies.get(SESSION_COOKIE)
+    return unquote(token) if isinstance(token, str) and token else None
+
+# Store a login token in the session cookie, or clear it when token is empty. Streamlit cannot set response
+# headers, so the browser sets it from a script; Secure is added when the app is served over https.
+def write_session_cookie(token):
+    max_age = SESSION_TTL if token else 0
+    secure = "; Secure" if (st.context.url or "").startswith("https:") else ""
+    value = json.dumps(token or "").replace("<", "\\u003c")
+    st.html(
+        f"<script>document.cookie = '{SESSION_COOKIE}=' + encodeURIComponent({value}) + "
+        f"'; path=/; max-age={max_age}; SameSite=Strict{secure}';</script>",
+        unsafe_allow_javascript=True,
+    )
+
+# Prompts catalog shown on the Prompts page and pre-warmed into the answer store.
+# Built once per process, when this module is first imported, and shared by every session as immutable records.
+def get_prompt_catalog():
+    catalog = [
+        ("🌿 How to Design Rooftop Gardening", [
+            "How to Design Rooftop Gardening",
+            "What are the key considerations for designing a rooftop garden?",
+            "How can I create a layout for my rooftop garden?",
+            "What types of containers are best for rooftop gardening?",
+            "How do I choose the right plants for my rooftop garden design?",
+            "What are the best materials for building raised beds on a rooftop?",
+            "How can I incorporate vertical gardening into my rooftop design?",
+            "What are some creative ways to use space in a small rooftop garden?",
+            "How can I design a rooftop garden that is aesthetically pleasing?",
+            "What are the best practices for ensuring proper drainage in a rooftop garden?",
+            "How can I create shaded areas in my rooftop garden?",
+        ]),
+        ("🌱 Which Crops to Grow in Which Season", [
+            "What vegetables can I grow in the spring on my rooftop?",
+            "Which herbs thrive in summer rooftop gardens?",
+            "What are the best fall crops for rooftop gardening?",
+            "How can I grow winter vegetables in a rooftop garden?",
+            "What are the best fruits to grow in a rooftop garden by season?",
+            "How do I choose companion plants for my rooftop garden?",
+            "What are the best crops for container gardening on rooftops?",
+            "How can I extend the growing season in my rooftop garden?",
+            "What are the best microgreens to grow indoors or on a rooftop?",
+            "How do seasonal changes affect plant selection for rooftop gardens?",
+        ]),
+        ("🌿 Proper Manure and Preparation Methods", [
+            "What types of manure are best for rooftop gardening?",
+            "How do I prepare manure for use in my rooftop garden?",
+            "What is the difference between compost and manure?",
+            "How can I make my own organic manure at home?",
+            "What are the benefits of using manure in rooftop gardening?",
+            "How do I apply manure to my rooftop garden?",
+            "What is the proper ratio of manure to soil for container gardening?",
+            "How can I tell if my manure is ready for use?",
+            "What precautions should I take when using manure in my garden?",
+            "How can I store manure safely for future use?",
+        ]),
+        ("💧 Techniques for Manure and Water Management", [
+            "What are the best techniques for composting on a rooftop?",
+            "How can I integrate rainwater harvesting into my rooftop garden?",
+            "What are the benefits of using drip irrigation in rooftop gardening?",
+            "How do I set up a simple irrigation system for my rooftop garden?",
+            "What are the best practices for watering plants in containers?",
+            "How can I use greywater in my rooftop garden?",
+            "What are the signs of overwatering in rooftop plants?",
+            "How can I create a self-watering system for my rooftop garden?",
+            "What are the best times of day to water rooftop plants?",
+            "How can I prevent water runoff from my rooftop garden?",
+        ]),
+        ("🐛 Pest Management in Rooftop Gardens", [
+            "What are common pests in rooftop gardens and how can I manage them?",
+            "How can I use companion planting to deter pests?",
+            "What natural pest control methods are effective for rooftop gardens?",
+            "How do I identify signs of pest infestations in my plants?",
+            "What are the best organic pesticides for rooftop gardening?",
+            "How can I attract beneficial insects to my rooftop garden?",
+            "What are the best practices for maintaining plant health to prevent pests?",
+            "How can I create barriers to protect my rooftop garden from pests?",
+            "What role do birds play in pest management on rooftops?",
+            "How can I use traps to control pests in my rooftop garden?",
+        ]),
+        ("🌱 Soil Preparation and Maintenance", [
+            "What is the best soil mix for rooftop gardening?",
+            "How do I test the soil quality in my rooftop garden?",
+            "What amendments can I add to improve rooftop garden soil?",
+            "How often should I refresh the soil in my containers?",
+            "What are the signs of nutrient deficiency in rooftop plants?",
+            "How can I improve drainage in my rooftop garden soil?",
+            "What are the best practices for mulching in rooftop gardens?",
+            "How do I prevent soil erosion on my rooftop garden?",
+            "What is the importance of soil pH in rooftop gardening?",
+            "How can I create a soil management plan for my rooftop garden?",
+        ]),
+        ("🌍 Sustainable Practices in Rooftop Gardening", [
+            "How can I make my rooftop garden more sustainable?",
+            "What are the benefits of using organic fertilizers in rooftop gardening?",
+            "How can I reduce waste in my rooftop garden?",
+            "What are the best practices for recycling materials in rooftop gardening?",
+            "How can I create a pollinator-friendly rooftop garden?",
+            "What are the benefits of using native plants in rooftop gardens?",
+            "How can I incorporate permaculture principles into my rooftop garden?",
+            "What are the best practices for sustainable water management in rooftop gardening?",
+            "How can I create a habitat for wildlife in my rooftop garden?",
+            "What are the benefits of using cover crops in rooftop gardening?",
+        ]),
+        ("🍂 Seasonal Care and Maintenance", [
+            "How do I prepare my rooftop garden for winter?",
+            "What are the best practices for spring planting in rooftop gardens?",
+            "How can I protect my rooftop garden from summer heat?",
+            "What fall maintenance tasks should I perform in my rooftop garden?",
+            "How do I manage plant growth during seasonal transitions?",
+            "What are the signs that my rooftop garden needs seasonal care?",
+            "How can I extend the growing season with season extenders?",
+            "What are the best practices for harvesting crops from a rooftop garden?",
+            "How do I clean and store gardening tools for seasonal changes?",
+            "What are the benefits of crop rotation in rooftop gardening?",
+        ]),
+        ("👥 Community and Education", [
+            "How can I get involved in community rooftop gardening projects?",
+            "What resources are available for learning about rooftop gardening?",
+            "How can I share my rooftop gardening experiences with others?",
+            "What are the benefits of joining a rooftop gardening club?",
+            "How can I teach children about rooftop gardening?",
+            "What workshops or classes are available for rooftop gardening enthusiasts?",
+            "How can I connect with local gardeners for advice and support?",
+            "What are the best online forums for rooftop gardening discussions?",
+            "How can I document my rooftop gardening journey?",
+            "What are the benefits of collaborating with local schools on gardening projects?",
+        ]),
+        ("🚀 Innovations in Rooftop Gardening", [
+            "What are the latest trends in rooftop gardening technology?",
+            "How can I use smart gardening tools in my rooftop garden?",
+            "What are the benefits of hydroponics in rooftop gardening?",
+            "How can I incorporate aquaponics into my rooftop garden?",
+            "What are the advantages of using green roofs in urban areas?",
+            "How can I utilize solar energy for my rooftop garden?",
+            "What are the best apps for managing a rooftop garden?",
+            "How can I use sensors to monitor plant health in my rooftop garden?",
+            "What innovative materials can I use for rooftop gardening?",
+            "How can I create a sustainable rooftop garden that adapts to climate change?",
+        ]),
+    ]
+    questions = ((category, text) for category, texts in catalog for text in texts)
+    return tuple(PromptRecord(prompt_id, category, text) for prompt_id, (category, text) in enumerate(questions, start=1))
+
+PROMPTS = get_prompt_catalog()